@@ -66,6 +66,14 @@ def get_squad_by_season(session, name, season):
     elif '@' in name:
         name = name.partition('@')[0].strip()
 
+    # Usually served from memory
+    index = TeamIndex.get(session)
+    team = index.team_by_name(name)
+    if team is not None:
+        squad = index.squad(team.id, season)
+        if squad is not None:
+            return squad
+
     try:
         return session.query(Squad)\
                       .join(Team)\
@@ -325,6 +333,29 @@ model but %r in the database" % (model_table.name, model_column.name,
                 print_warning("Column %s.%s in the database is not in \
 the model ... leaving be, for now." % (model_table.name, model_column.name))
 
+            _create_missing_indexes(engine, model_table, db_table)
+
+
+def _create_missing_indexes(engine, model_table, db_table):
+    '''Create indexes that are declared in the model but missing in the
+    database. A unique index can't be built on a table that already holds
+    duplicates; these are reported and skipped, not fixed.'''
+    print_info("Checking for missing indexes on %s ..." % model_table.name)
+
+    db_indexes = set(unicode(i.name) for i in db_table.indexes)
+
+    for index in sorted(model_table.indexes, key=lambda i: i.name):
+        if unicode(index.name) in db_indexes:
+            continue
+
+        print_good("Adding index %s on %s(%s)" % (index.name,
+                    model_table.name, ', '.join(c.name for c in index.columns)))
+        try:
+            index.create(bind=engine)
+        except (exc.IntegrityError, exc.OperationalError) as e:
+            print_warning("Couldn't create index %s: %s. Remove duplicate rows \
+from %s and run again." % (index.name, e.orig, model_table.name))
+
 
 def _column_names(table):
     # Autoloaded columns return unicode column names
@@ -381,6 +412,16 @@ at games played after last Game in DB", action='store_true')
     parser.add_argument('-y', '--yes', dest='yesall', help="Yes to prompts",
                         action='store_true')
 
+    parser.add_argument('-d', '--derive', dest='derive', metavar='season',
+                        nargs='?', const='all', default=None,
+                        help='rebuild derived stats cache for given season \
+(or for all seasons, if none is given)')
+
+    parser.add_argument('-b', '--backfill', dest='backfill', metavar='season',
+                        nargs='?', const='all', default=None,
+                        help='fill in missing derived stats for given season \
+(or for all seasons, if none is given)')
+
 
     cli = parser.parse_args()
 
@@ -453,8 +494,8 @@ id=%d: `%s`" % (int(entry[1]), old.name))
             refteam = None
             bestmatches = []
 
-            for cell in line:
-                bestmatches.extend(Team.search(session, cell))
+            for matches in Team.search_many(session, line):
+                bestmatches.extend(matches)
 
             # Sort bestmatches high to low
             bestmatches = sorted(bestmatches, key=lambda d: d[1])
@@ -470,13 +511,11 @@ id=%d: `%s`" % (int(entry[1]), old.name))
 
             for cell in line:
                 # Add (new) aliases to DB
-                try:
-                    # Try to find Alias in DB
-                    normalias = normalize_name(cell)
-                    session.query(TeamAlias).filter_by(name=normalias).one()
+                if TeamIndex.get(session).team_id(cell) is not None:
+                    # Alias is already in DB
                     print_comment("Alias `%s` already present for `%s`" \
                                     % (cell, refteam.name))
-                except:
+                else:
                     # This means alias isn't in DB; add it
                     newteamalias = TeamAlias(cell)
                     newteamalias.team = refteam
@@ -580,11 +619,7 @@ team aliases." % (entry[7]))
                     exit(11)
 
                 # -- Determine whether Squad is already defined in Team
-                squad = None
-                for teamsquad in team.squads:
-                    if teamsquad.season==entry[6]:
-                        squad = teamsquad
-                        break
+                squad = TeamIndex.get(session).squad(team.id, entry[6])
 
                 if squad is None:
                     print_info("No info yet on team %s in %s" % \
@@ -792,10 +827,7 @@ for anyone ever.")
 do it by hand.")
                         exit(22)
                 # Get Squad for Team in given season
-                squad = session.query(Squad)\
-                                .filter(Squad.team_id==last_team.id)\
-                                .filter(Squad.season==season)\
-                                .first()
+                squad = TeamIndex.get(session).squad(last_team.id, season)
 
                 if squad is None:
                     print_error("Squad does not exist for %s in the \
@@ -890,11 +922,7 @@ season %s ... Creating ..." \
                     changed = True
 
             # Got opponent. Now get opponents Squad, if possible
-            opponent_squad = None
-            for osquad in opponent.squads:
-                if osquad.season==season:
-                    opponent_squad = osquad
-                    break
+            opponent_squad = TeamIndex.get(session).squad(opponent.id, season)
             if opponent_squad is None:
                 print_warning("Warning: Creating empty Squad for \
 team `%s` in season `%s`!" % (opponent_name, season))
@@ -953,6 +981,7 @@ team `%s` in season `%s`!" % (opponent_name, season))
                             winner_score=score_high, loser_score=score_low)
 
                 session.add(game)
+                game.update_derived_stats()
                 print_good("Successfully created game.")
 
             # Finally, create a statsheet and associate it with the
@@ -1001,6 +1030,9 @@ team `%s` in season `%s`!" % (opponent_name, season))
 
                 statsheet.fouls = get_int(entry[25])
 
+                # Keep cached derived stats current
+                statsheet.update_derived_stats()
+
                 print_good("Successfully entered data for player.")
 
             # Update Database with changes, sporadically
@@ -1137,3 +1169,39 @@ be very wrong with the database. You should check it by hand.")
 
 
 
+    # --------------------------------- //
+    if cli.derive:
+        # Recompute cached derived stats in bulk.
+        season = None if cli.derive=='all' else cli.derive
+        print_info("Rebuilding derived stats for %s ..." \
+                        % ('all seasons' if season is None else season))
+        nmembers, nsquads = DerivedStats.rebuild(session, season=season)
+        print_comment("Derived stats for %d squad members and %d squads" \
+                        % (nmembers, nsquads))
+        session.commit()
+        print_success("All finished!")
+
+
+
+    # --------------------------------- //
+    if cli.backfill:
+        # Fill in cached derived stats that haven't been computed yet.
+        season = None if cli.backfill=='all' else cli.backfill
+        print_info("Backfilling derived stats for %s ..." \
+                        % ('all seasons' if season is None else season))
+        nmembers, nsquads = DerivedStats.backfill(session, season=season)
+        print_comment("Derived stats for %d squad members and %d squads" \
+                        % (nmembers, nsquads))
+        session.commit()
+        print_success("All finished!")
+
+
+
+    # --------------------------------- //
+    if cli.players or cli.quickadd or cli.gamestats or cli.patchscores:
+        # Rosters, games or scores changed, so the set of Games with complete
+        # data might have, too.
+        print_info("Indexing games with complete data ...")
+        ngames = Game.index_complete_games(session)
+        session.commit()
+        print_comment("Found %d games with complete data" % ngames)
@@ -19,7 +19,11 @@ if __name__=='__main__':
         exit(1)
     session = load_db(argv[1])
 
-    print >>stderr, "\033[92mLoaded DB ... loading squads ...\033[0m"
+    print >>stderr, "\033[92mLoaded DB ... deriving stats ...\033[0m"
+
+    DerivedStats.rebuild(session)
+
+    print >>stderr, "Done deriving stats ... loading squads ..."
 
 
     records = session.query(Squad).all()
@@ -89,7 +93,6 @@ if __name__=='__main__':
 
     for i, record in enumerate(records):
         print >>stderr, "%d / %d\t%s ... " % (i, n, record.team.name)
-        record.derive_stats()
         row = [
             record.team.id,
             record.id,
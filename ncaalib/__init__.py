@@ -1 +1 @@
-__all__ = ['ncaa', 'data']
+__all__ = ['ncaa', 'data', 'frame', 'views', 'bracket']
@@ -0,0 +1,856 @@
+#-*- coding: utf8 -*-
+'''
+ncaalib.bracket
+
+Transient Tournament brackets and vectorized Monte Carlo simulation.
+
+Tournament.simulate fills in one bracket at a time, going through the ORM
+and calling the decision function once per game. To estimate how likely
+each Squad is to advance, that has to be repeated many thousands of times.
+BracketSimulator instead plays N brackets at once: every round is one
+random draw per game across all N brackets, compared against a pairwise
+win-probability matrix.
+
+Brackets are laid out like Tournament lays out its games: a binary heap with
+the championship at 0 and the children of game i at 2i+1 and 2i+2. The
+Squads entering the bracket are the leaves below the last round, so a
+bracket with R rounds has 2^R leaves and 2^R - 1 games. Squads are given as
+rows of the probability matrix; -1 is a bye, which always loses. That is
+how play-in rounds are handled: a Squad that doesn't play in, plays a bye
+instead.
+
+Bracket is a transient Tournament: the Squads entering it and the winners
+and losers of its games are kept in int arrays in heap order, so simulating,
+correcting, scoring and exporting a bracket never touch the ORM. Convert with
+Bracket.from_tournament and Bracket.to_tournament.
+
+BracketSimulator and the functions below only depend on numpy.
+
+Copyright (c) 2013 Joe Nudell.
+Freely distributable under the MIT License.
+'''
+
+from ncaa import BracketLayout
+from frame import or_missing, to_int
+from multiprocessing import Pool
+import copy
+import json
+import numpy as np
+
+
+
+
+class BracketSimulator(object):
+    '''Simulate brackets given the leaves of the bracket and a matrix of
+    win probabilities, where probs[i, j] is the probability that Squad row
+    i beats Squad row j. In each game the Squad from the left child (the
+    odd heap index) is i and the one from the right child is j.
+
+    Use from_tournament to set up a simulator for a Tournament.'''
+
+    def __init__(self, leaves, probs, random_state=None, chunksize=65536):
+        leaves = np.asarray(leaves, dtype=int)
+        probs = np.asarray(probs, dtype=float)
+
+        self.rounds = int(np.log2(len(leaves)))
+        if len(leaves)!=1<<self.rounds or self.rounds<1:
+            raise ValueError("Number of leaves must be a power of 2")
+        if probs.ndim!=2 or probs.shape[0]!=probs.shape[1]:
+            raise ValueError("Probability matrix must be square")
+        if leaves.max()>=len(probs) or leaves.min()<-1:
+            raise ValueError("Leaves must be rows of probs, or -1 for byes")
+
+        self.n = len(probs)
+        self.leaves = leaves
+        self.probs = probs
+        self.chunksize = chunksize
+
+        if isinstance(random_state, np.random.RandomState):
+            self.random_state = random_state
+        else:
+            self.random_state = np.random.RandomState(random_state)
+
+        n = self.n
+        self._probs = _with_bye(probs).ravel()
+        self._leaves = np.where(leaves<0, n, leaves)
+
+        # Games of each round that are played, i.e. not against a bye
+        bye = leaves<0
+        self._decided = [None] * self.rounds
+        for depth in xrange(self.rounds-1, -1, -1):
+            self._decided[depth] = ~(bye[0::2] | bye[1::2])
+            bye = bye[0::2] & bye[1::2]
+
+        # Smallest dtype that fits a Squad row (or the bye)
+        self._dtype = np.int16 if n < np.iinfo(np.int16).max else np.int32
+
+    @classmethod
+    def from_tournament(cls, tournament, probs, rows, **kwargs):
+        '''Simulator for the (empty or filled in) bracket of tournament.
+        rows maps Squad IDs to rows of probs. See tournament_leaves for how
+        the leaves are found.'''
+        leaves = [-1 if s is None else rows[s.id]
+                    for s in tournament_leaves(tournament)]
+        return cls(leaves, probs, **kwargs)
+
+    @property
+    def ngames(self):
+        return (1<<self.rounds) - 1
+
+    def simulate(self, n, outcomes=False, chunksize=None):
+        '''Simulate n brackets.
+
+        Returns counts, an (n squads x rounds) array where counts[s, r] is
+        the number of brackets in which Squad row s won its game in round r.
+        Rounds are numbered like Tournament.rounds: 0 is the championship,
+        so counts[:, 0] are championships and counts[:, 1] appearances in
+        the final. Going through against a bye isn't counted as a win.
+
+        If outcomes is True, returns (counts, outcomes), where outcomes is
+        an (n x games) array of the Squad row that won each game, with games
+        in heap order and -1 for games won by a bye. The array holds n x
+        (2^rounds - 1) small ints, so mind memory with large n.
+
+        Brackets are simulated chunksize at a time (default
+        self.chunksize).'''
+        chunksize = chunksize or self.chunksize
+
+        counts = np.zeros((self.n+1, self.rounds), dtype=np.int64)
+        out = None
+        if outcomes:
+            out = np.empty((n, self.ngames), dtype=self._dtype)
+
+        for start in xrange(0, n, chunksize):
+            stop = min(n, start+chunksize)
+            chunk = out[start:stop] if outcomes else None
+            self._simulate_chunk(stop-start, counts, chunk)
+
+        counts = counts[:self.n]
+        if outcomes:
+            out[out==self.n] = -1
+            return counts, out
+        return counts
+
+    def _simulate_chunk(self, n, counts, out):
+        '''Play n brackets, round by round from the leaves up. Adds to counts
+        and fills out (if given) in place.'''
+        m = self.n + 1
+        probs = self._probs
+        rand = self.random_state.random_sample
+
+        alive = np.empty((n, len(self._leaves)), dtype=self._dtype)
+        alive[:] = self._leaves
+
+        for depth in xrange(self.rounds-1, -1, -1):
+            a = alive[:, 0::2]
+            b = alive[:, 1::2]
+            p = probs[a.astype(np.intp)*m + b]
+            alive = np.where(rand(p.shape) < p, a, b)
+
+            decided = alive[:, self._decided[depth]]
+            counts[:, depth] += np.bincount(decided.ravel(), minlength=m)
+            if out is not None:
+                out[:, (1<<depth)-1:(1<<(depth+1))-1] = alive
+
+    def probabilities(self, n, **kwargs):
+        '''Estimated probability of each Squad row winning in each round,
+        from n simulated brackets. Same layout as simulate's counts. See
+        exact_probabilities for the exact values.'''
+        return self.simulate(n, **kwargs) / float(n)
+
+    def exact_probabilities(self):
+        '''Exact probability of each Squad row winning in each round. Same
+        layout as simulate's counts.'''
+        return advancement_probabilities(self.leaves, self.probs)
+
+
+
+
+class Bracket(BracketLayout):
+    '''Transient bracket, laid out like Tournament: a heap of games with the
+    championship at 0. Works like a Tournament for simulate, score, correct
+    and export, and indexing gives game views with opponents, winner and
+    loser, but nothing is stored in or read from the DB.
+
+    squads are the Squads entering the bracket (anything with an id will do
+    for simulating and scoring) and leaves are the 2^R rows of squads below
+    the R rounds, -1 for byes, as in BracketSimulator. A play-in game
+    against a bye isn't played; its Squad goes straight to the first round,
+    as in an empty Tournament. winners and losers are rows of squads for
+    each game, -1 if the game hasn't been decided.'''
+
+    # Transient default scores, as on Tournament
+    roundpoints = [320, 160, 80, 40, 20, 10, 0]
+
+    def __init__(self, season, squads, leaves, rounds,
+                 regions=['North', 'East', 'South', 'West'],
+                 delim='/', playin=None, id=None):
+        self.season = season
+        self.squads = list(squads)
+        self.leaves = np.asarray(leaves, dtype=int)
+        self.rounds = list(rounds)
+        self.regions = list(regions)
+        self.delim = delim
+        self.playin = playin
+        self.id = id
+
+        if len(self.leaves)!=1<<len(self.rounds):
+            raise ValueError("Need 2^%d leaves" % len(self.rounds))
+
+        self.ids = np.array([s.id for s in self.squads], dtype=int)
+        self._rows = dict((s.id, i) for i, s in enumerate(self.squads))
+
+        # Games against byes in the last round are never played
+        g = len(self.leaves) - 1
+        self._bye = np.zeros(g, dtype=bool)
+        pairs = self.leaves.reshape(-1, 2)
+        self._bye[g>>1:] = pairs.min(axis=1) < 0
+
+        self.pointsmap = dict(zip(self.rounds, self.roundpoints))
+        self.points = None
+        self.accurate = None
+        self.clear()
+
+    @classmethod
+    def from_tournament(cls, tournament, squads=None, rows=None):
+        '''Copy of a Tournament, empty or filled in. See tournament_leaves for
+        how the leaves are found. To use other objects than the Tournament's
+        own Squads, e.g. SquadViews, pass them as squads, along with rows
+        mapping Squad IDs to their positions in squads.'''
+        leaves = tournament_leaves(tournament)
+        if squads is None:
+            squads = []
+            rows = dict()
+            for squad in leaves:
+                if squad is not None and squad.id not in rows:
+                    rows[squad.id] = len(squads)
+                    squads.append(squad)
+
+        bracket = cls(tournament.season, squads,
+                      [-1 if s is None else rows[s.id] for s in leaves],
+                      tournament.rounds, tournament.regions,
+                      delim=tournament.delim, playin=tournament.playin,
+                      id=tournament.id)
+
+        for i, tgame in enumerate(tournament.games):
+            if tgame.winner is not None and not bracket._bye[i]:
+                bracket.winners[i] = rows[tgame.winner.id]
+                bracket.losers[i] = rows[tgame.loser.id]
+                bracket.winner_scores[i] = or_missing(tgame.winner_score)
+                bracket.loser_scores[i] = or_missing(tgame.loser_score)
+        return bracket
+
+    def to_tournament(self, season=None):
+        '''New Tournament with the same Squads, winners, losers and scores.
+        season is the Tournament's moniker (default self.season). Squads
+        must be ORM Squads. Like any Tournament with Squads in it, it ends up
+        in their session.'''
+        from ncaa import Tournament
+
+        if season is None:
+            season = self.season
+        tournament = Tournament(season, rounds=self.rounds,
+                                regions=self.regions, delim=self.delim,
+                                playin=self.playin)
+        for i, tgame in enumerate(tournament.games):
+            game = self[i]
+            tgame.opponents = game.opponents
+            tgame.winner = game.winner
+            tgame.loser = game.loser
+            tgame.winner_score = game.winner_score
+            tgame.loser_score = game.loser_score
+        return tournament
+
+    def empty(self, season=None):
+        '''Copy of the Bracket without winners and losers, named season
+        (default self.season). Squads, leaves and layout are shared with this
+        Bracket, since they never change, so this only costs new arrays of
+        winners and losers.'''
+        bracket = object.__new__(type(self))
+        bracket.__dict__.update(self.__dict__)
+        bracket.__dict__.pop('_correctedAgainst', None)
+        if season is not None:
+            bracket.season = season
+        bracket.id = None
+        bracket.pointsmap = dict(self.pointsmap)
+        bracket.points = None
+        bracket.accurate = None
+        bracket.clear()
+        return bracket
+
+    def clear(self):
+        '''Forget all winners and losers.'''
+        g = len(self.leaves) - 1
+        self.winners = -np.ones(g, dtype=int)
+        self.losers = -np.ones(g, dtype=int)
+        self.winner_scores = -np.ones(g, dtype=int)
+        self.loser_scores = -np.ones(g, dtype=int)
+
+    def opponents(self, i):
+        '''Rows of the Squads in game i, in the order Tournament.simulate
+        would have them: Squads that went straight into the game first, then
+        winners of the games below it, right one first.'''
+        if self._bye[i]:
+            return []
+        g = len(self.leaves)
+        left, right = 2*i+1, 2*i+2
+        if left >= g - 1:
+            return [r for r in self.leaves[left-g+1:right-g+2] if r>=0]
+
+        ret = [self.leaves[2*c-g+2:2*c-g+4].max()
+                for c in (left, right) if self._bye[c]]
+        ret += [self.winners[c] for c in (right, left)
+                    if not self._bye[c] and self.winners[c]>=0]
+        return [r for r in ret if r>=0]
+
+    def simulate(self, decide, precompute=False):
+        '''Simulate the bracket with a decision function, like
+        Tournament.simulate, after clearing it. decide gets game views and
+        may return the winning Squad, the index of the winner in opponents,
+        a (winner, loser) tuple, an array whose first item is that index,
+        or the game view itself with winner set. decide_many is used if
+        decide has it, and precompute if asked to.'''
+        self.clear()
+        if precompute and hasattr(decide, 'precompute'):
+            decide.precompute([self.squads[r] for r in self.leaves if r>=0])
+        decide_many = getattr(decide, 'decide_many', None)
+
+        for depth in xrange(len(self.rounds)-1, -1, -1):
+            games = []
+            for i in xrange((1<<(depth+1))-2, (1<<depth)-2, -1):
+                if self._bye[i]:
+                    continue
+                game = self[i]
+                if len(game.opponents)!=2:
+                    raise IndexError("%s opponents in game %d" \
+                                        % (len(game.opponents), i))
+                games.append(game)
+
+            if decide_many is not None:
+                results = decide_many(games)
+            else:
+                results = [decide(game) for game in games]
+
+            for game, r in zip(games, results):
+                self._record_decision(game, r)
+
+    def _record_decision(self, game, r):
+        '''Set winner and loser of game from what a decision function
+        returned.'''
+        ops = game.opponents
+        if type(r) is BracketGame:
+            if r.winner is None:
+                raise ValueError("Winner not set on returned game.")
+            return
+        elif type(r) is tuple or type(r) is list:
+            i = ops.index(r[0])
+        elif hasattr(r, 'id'):
+            i = ops.index(r)
+        elif isinstance(r, (int, np.integer)):
+            i = int(r)
+        elif type(r) is np.ndarray:
+            i = int(r[0])
+        else:
+            raise NotImplementedError("Unsupported sim return type %s"\
+                                        % type(r))
+        game.winner = ops[i]
+        game.loser = ops[(i+1)%2]
+
+    def correct(self, realtourny):
+        '''Compare with the actual results, a Tournament or a Bracket. Sets
+        self.accurate to an array of 1 where the winner of a game was
+        picked correctly, 0 where it wasn't and -1 where the game hasn't
+        been played. Returns self.accurate.'''
+        if not isinstance(realtourny, Bracket):
+            realtourny = Bracket.from_tournament(realtourny)
+        self._correctedAgainst = realtourny.id
+
+        ids = np.append(self.ids, -1)
+        real_ids = np.append(realtourny.ids, -1)
+        picked = ids[self.winners]
+        actual = real_ids[realtourny.winners]
+        self.accurate = np.where(realtourny.winners<0, -1, picked==actual)
+        return self.accurate
+
+    def score(self, realtourny, pointsmap=None):
+        '''Score against the actual results, a Tournament or a Bracket. By
+        default uses the scoring system used by ESPN; pointsmap may be a list
+        of points per round starting from the Championship or a dict of
+        points by round label, as for Tournament.score. Returns the score,
+        which is also kept in self.points.'''
+        if type(pointsmap) is list:
+            self.pointsmap = dict(zip(self.rounds, pointsmap))
+        elif type(pointsmap) is dict:
+            for key, val in pointsmap.items():
+                if key not in self.rounds:
+                    raise NameError("Tried to map value %d to unknown round %s"
+                                        % (val, key))
+                self.pointsmap[key] = val
+        elif pointsmap is not None:
+            raise ValueError("pointsmap something other than list or dict")
+
+        accurate = self.correct(realtourny)
+        points = np.array(self.round_points())
+        self.points = int(points[round_index(len(self))][accurate==1].sum())
+        return self.points
+
+    @property
+    def games(self):
+        return [self[i] for i in xrange(len(self))]
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("No game %d" % n)
+        return BracketGame(self, n)
+
+    def __iter__(self):
+        return (self[i] for i in xrange(len(self)-1, -1, -1))
+
+    def __len__(self):
+        return len(self.leaves) - 1
+
+    def __repr__(self):
+        return "<Bracket('%s')>" % self.season
+
+
+
+
+class BracketGame(object):
+    '''View of a game in a Bracket, with the attributes of a TournamentGame.
+    Setting winner or loser writes through to the Bracket.'''
+
+    __slots__ = ('bracket', 'index')
+
+    def __init__(self, bracket, index):
+        self.bracket = bracket
+        self.index = index
+
+    def _squad(self, row):
+        return self.bracket.squads[row] if row>=0 else None
+
+    def _row(self, squad):
+        return -1 if squad is None else self.bracket._rows[squad.id]
+
+    @property
+    def opponents(self):
+        return [self.bracket.squads[r]
+                    for r in self.bracket.opponents(self.index)]
+
+    @property
+    def winner(self):
+        return self._squad(self.bracket.winners[self.index])
+
+    @winner.setter
+    def winner(self, squad):
+        self.bracket.winners[self.index] = self._row(squad)
+
+    @property
+    def loser(self):
+        return self._squad(self.bracket.losers[self.index])
+
+    @loser.setter
+    def loser(self, squad):
+        self.bracket.losers[self.index] = self._row(squad)
+
+    @property
+    def winner_score(self):
+        return to_int(self.bracket.winner_scores[self.index])
+
+    @property
+    def loser_score(self):
+        return to_int(self.bracket.loser_scores[self.index])
+
+    @property
+    def tournament(self):
+        return self.bracket
+
+    def next(self):
+        if self.index==0:
+            return None
+        return self.bracket[((self.index+1) >> 1) - 1]
+
+    def __contains__(self, squad):
+        return squad in self.opponents
+
+    def __repr__(self):
+        round_, region, n = self.bracket.lookup(self.index)
+        names = " vs. ".join(str(getattr(s, 'id', s))
+                                for s in self.opponents)
+        return "<BracketGame('%s', '%s', '%s', '%s', '%s')>" \
+                % (self.bracket.season, round_, region, n, names)
+
+
+
+
+class BracketScorer(object):
+    '''Score many brackets at once against the actual results. actual are
+    the IDs of the real winners of each game in heap order (-1 where the
+    game hasn't been played or was a bye) and points are the points for a
+    correct pick in each round, Championship first.'''
+
+    def __init__(self, actual, points):
+        self.actual = np.asarray(actual, dtype=int)
+        self.rounds = int(np.log2(len(self.actual)+1))
+        if len(self.actual)!=(1<<self.rounds)-1:
+            raise ValueError("Number of games must be 2^rounds - 1")
+
+        self.points = np.asarray(points[:self.rounds])
+        self.round_index = round_index(len(self.actual))
+
+        self._played = self.actual>=0
+        self._starts = (1<<np.arange(self.rounds)) - 1
+        self._weights = self.points[self.round_index] * self._played
+
+    @classmethod
+    def from_tournament(cls, tournament, pointsmap=None):
+        '''Scorer for the results in tournament (a Tournament or Bracket),
+        with the given points (see BracketLayout.round_points).'''
+        actual = [-1 if g.winner is None else g.winner.id
+                    for g in tournament.games]
+        return cls(actual, tournament.round_points(pointsmap))
+
+    def score(self, picks):
+        '''Score an (N brackets x games) array of the IDs of picked winners,
+        in heap order. A single bracket may be given as a 1-d array.
+
+        Returns (scores, correct), where scores has the score of each
+        bracket and correct is an (N x rounds) array of the number of
+        correct picks in each round, Championship first.'''
+        picks = np.atleast_2d(picks)
+        hits = (picks==self.actual) & self._played
+        # Rounds are contiguous in the heap, so count each round at once
+        correct = np.add.reduceat(hits, self._starts, axis=1, dtype=np.int32)
+        return correct.dot(self.points), correct
+
+    def __call__(self, picks):
+        '''Scores of the brackets in picks, without the counts by round. See
+        score.'''
+        return (np.atleast_2d(picks)==self.actual).dot(self._weights)
+
+
+
+
+class PoolSimulator(object):
+    '''Chances of each entry in a bracket pool to finish first, or in the top
+    k, estimated by simulating the tournament many times and scoring every
+    entry against every outcome.
+
+    entries is an (entries x games) array of the Squad rows of simulator
+    that each entry picked to win each game, in heap order (-1 for byes; see
+    entry_picks), and points are the points for a correct pick in each
+    round, Championship first. Outcomes are simulated and scored chunksize
+    at a time, in n_jobs processes if asked to.'''
+
+    def __init__(self, simulator, entries, points, random_state=None,
+                 chunksize=4096):
+        self.simulator = simulator
+        self.entries = np.atleast_2d(np.asarray(entries, dtype=int))
+        self.points = list(points)
+        self.chunksize = chunksize
+
+        if self.entries.shape[1]!=simulator.ngames:
+            raise ValueError("Entries must have a pick for each of %d games"
+                                % simulator.ngames)
+
+        if isinstance(random_state, np.random.RandomState):
+            self.random_state = random_state
+        else:
+            self.random_state = np.random.RandomState(random_state)
+
+        # Scoring an entry against many outcomes is scoring many brackets
+        # against that entry
+        self._scorers = [BracketScorer(entry, self.points)
+                            for entry in self.entries]
+
+    @classmethod
+    def from_tournament(cls, tournament, prob_fn, entries, pointsmap=None,
+                        **kwargs):
+        '''Pool of entries for tournament, given prob_fn(a, b), the
+        probability that Squad a beats Squad b. Entries may be Tournaments,
+        Brackets or their exports (see entry_picks). Points are the
+        tournament's (see BracketLayout.round_points).'''
+        squads, leaves, probs = tournament._bracket_matrix(prob_fn)
+        rows = dict((squad.id, i) for i, squad in enumerate(squads))
+        simulator = BracketSimulator(leaves, probs)
+        picks = [entry_picks(entry, rows) for entry in entries]
+        return cls(simulator, picks, tournament.round_points(pointsmap),
+                   **kwargs)
+
+    def simulate(self, n, k=1, n_jobs=1):
+        '''Simulate n tournaments and rank the entries in each.
+
+        Returns (first, top, expected), arrays with for each entry the
+        probability of finishing first, of finishing in the top k and its
+        expected score. Entries that tie for first share the win; entries
+        that tie with the k-th best score are in the top k.
+
+        Chunks are given their own seeds up front, so results only depend on
+        random_state, not on n_jobs.'''
+        sizes = [min(self.chunksize, n-start)
+                    for start in xrange(0, n, self.chunksize)]
+        seeds = self.random_state.randint(np.iinfo(np.int32).max,
+                                          size=len(sizes))
+        tasks = [(self, size, seed, k) for size, seed in zip(sizes, seeds)]
+
+        if n_jobs==1:
+            results = map(_pool_chunk, tasks)
+        else:
+            pool = Pool(n_jobs if n_jobs>0 else None)
+            try:
+                results = pool.map(_pool_chunk, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        first, top, total = [sum(r) for r in zip(*results)]
+        return first / float(n), top / float(n), total / float(n)
+
+    def scores(self, outcomes):
+        '''(outcomes x entries) array of the score of each entry, given an
+        (outcomes x games) array of the Squad rows that won each game.'''
+        scores = np.empty((len(outcomes), len(self.entries)))
+        for e, scorer in enumerate(self._scorers):
+            scores[:, e] = scorer(outcomes)
+        return scores
+
+    def _rank(self, scores, k):
+        '''Wins (shared on ties), top k finishes and total score of each
+        entry over the outcomes in scores.'''
+        best = scores.max(axis=1)[:, np.newaxis]
+        at_best = scores==best
+        first = (at_best / at_best.sum(axis=1, dtype=float)[:, np.newaxis])\
+                    .sum(axis=0)
+
+        k = min(k, scores.shape[1])
+        kth = np.partition(scores, -k, axis=1)[:, -k][:, np.newaxis]
+        top = (scores>=kth).sum(axis=0)
+        return first, top, scores.sum(axis=0)
+
+
+
+
+# -- HELPER FUNCTIONS -- //
+def _pool_chunk(task):
+    '''Simulate and rank one chunk of a PoolSimulator's outcomes. Module
+    level so that it can be run by multiprocessing.'''
+    pool, n, seed, k = task
+    simulator = copy.copy(pool.simulator)
+    simulator.random_state = np.random.RandomState(seed)
+    _, outcomes = simulator.simulate(n, outcomes=True)
+    return pool._rank(pool.scores(outcomes), k)
+
+
+def entry_picks(entry, rows):
+    '''Squad rows picked to win each game of a bracket, in heap order, -1
+    where there is no winner. entry is a Tournament, a Bracket, or an
+    export of either (a JSON string or its decoded dict, 'heap' or
+    'nested'). 'nested' exports don't include play-in games, so those are
+    -1. rows maps Squad IDs to rows.'''
+    if isinstance(entry, basestring):
+        entry = json.loads(entry)
+
+    if isinstance(entry, dict):
+        # Export: nodes below the last round are opponents, not winners
+        ngames = (1<<len(entry['rounds'])) - 1
+        sids = [None] * ngames
+        stack = entry['nodes']
+        stack = list(stack) if type(stack) is list else [stack]
+        while stack:
+            node = stack.pop()
+            children = node.get('children')
+            if children==[]:
+                # Leaf of a 'nested' export, i.e. a first round opponent.
+                # With a play-in round it has the ID of a play-in game,
+                # which it didn't necessarily win, so it's no pick.
+                continue
+            if node['id'] < ngames:
+                sids[node['id']] = node['data']['sid']
+            stack.extend(children or [])
+    else:
+        sids = [None if g.winner is None else g.winner.id
+                    for g in entry.games]
+
+    try:
+        return [-1 if sid is None else rows[sid] for sid in sids]
+    except KeyError as e:
+        raise ValueError("Squad %s isn't in the bracket" % e.args[0])
+
+
+def round_index(ngames):
+    '''Round of each game in a heap of ngames games, i.e. log2(i+1) rounded
+    down, with the Championship as round 0.'''
+    return np.log2(np.arange(1, ngames+1)).astype(int)
+
+
+def advancement_probabilities(leaves, probs):
+    '''Exact probability of each Squad row winning its game in each round of
+    the bracket with given leaves (rows of probs, -1 for byes), where
+    probs[i, j] is the probability that i beats j when i comes from the left
+    child. Same layout as BracketSimulator.simulate's counts: an (n squads x
+    rounds) array with the championship in column 0. A Squad that plays a
+    bye goes through with probability 1, which isn't counted as a win.
+
+    Works up the heap one round at a time, keeping for every slot the
+    distribution of the Squad that occupies it, over the leaves below the
+    slot. The winner of a game is left Squad i with probability
+    left[i] * sum_j probs[i, j] right[j], and right Squad j with probability
+    right[j] * sum_i left[i] (1-probs[i, j]), where i and j only run over
+    the leaves of either half. Opponents in a game come from disjoint halves
+    of the bracket, so their distributions are independent. A game with m
+    leaves on either side costs O(m^2), so each round costs O(squads^2 / 2)
+    at most, and all of them together O(squads^2).'''
+    leaves = np.asarray(leaves, dtype=int)
+    rounds = int(np.log2(len(leaves)))
+    if len(leaves)!=1<<rounds or rounds<1:
+        raise ValueError("Number of leaves must be a power of 2")
+
+    n = len(probs)
+    p = _with_bye(np.asarray(probs, dtype=float))
+
+    # Squad rows of the leaves below each slot, and their probabilities of
+    # occupying it. Slots that only have byes below them are byes.
+    rows = np.where(leaves<0, n, leaves)[:, np.newaxis]
+    dist = np.ones((len(leaves), 1))
+    bye = leaves<0
+
+    ret = np.zeros((n+1, rounds))
+    for depth in xrange(rounds-1, -1, -1):
+        lrows, rrows = rows[0::2], rows[1::2]
+        left, right = dist[0::2], dist[1::2]
+        lbye, rbye = bye[0::2], bye[1::2]
+
+        # probs of each left Squad against each right Squad, game by game
+        block = p[lrows[:, :, np.newaxis], rrows[:, np.newaxis, :]]
+        lwins = left * np.einsum('gij,gj->gi', block, right)
+        rwins = right * np.einsum('gij,gi->gj', 1.-block, left)
+
+        # Against a bye, the other side goes through without a game
+        lwins[rbye] = left[rbye]
+        rwins[rbye] = 0.
+        walkover = lbye & ~rbye
+        lwins[walkover] = 0.
+        rwins[walkover] = right[walkover]
+
+        rows = np.hstack([lrows, rrows])
+        dist = np.hstack([lwins, rwins])
+        decided = ~(lbye | rbye)
+        ret[:, depth] = np.bincount(rows[decided].ravel(),
+                                    weights=dist[decided].ravel(),
+                                    minlength=n+1)
+        bye = lbye & rbye
+    return ret[:n]
+
+
+def optimal_bracket(leaves, probs, points):
+    '''Bracket with the highest expected score, where a correctly picked
+    winner of a game in round r earns points[r] (championship first, like
+    Tournament.roundpoints). Leaves and probs are as in
+    advancement_probabilities.
+
+    Picking Squad w to win game g in round r earns points[r] times the
+    probability that w really wins g, whatever else is picked. So the best
+    subtree value of g given that w is picked to win it is
+
+        V[g, w] = points[r] * P(w wins g) + V[c, w] + max_u V[c', u]
+
+    where c is the child of g that w comes from and c' the other one. This
+    is computed bottom up for all w at once, then the picks are read off top
+    down. Runs in O(games x squads).
+
+    Returns (picks, expected), where picks is an array of the Squad row
+    picked to win each game, in heap order (-1 for byes), and expected is
+    the expected score of the bracket.'''
+    leaves = np.asarray(leaves, dtype=int)
+    rounds = int(np.log2(len(leaves)))
+    n = len(probs)
+    adv = np.zeros((n+1, rounds))
+    adv[:n] = advancement_probabilities(leaves, probs)
+
+    # Subtree values; -inf for Squads that aren't in the subtree
+    values = np.empty((len(leaves), n+1))
+    values.fill(-np.inf)
+    values[np.arange(len(leaves)), np.where(leaves<0, n, leaves)] = 0.
+
+    # Values of every round, deepest first, for reading off the picks
+    levels = []
+    for depth in xrange(rounds-1, -1, -1):
+        left, right = values[0::2], values[1::2]
+        best_left = left.max(axis=1)[:, np.newaxis]
+        best_right = right.max(axis=1)[:, np.newaxis]
+        values = np.where(left>-np.inf, left + best_right, right + best_left)
+        values += points[depth] * adv[:, depth]
+        levels.append(values)
+    levels.reverse()
+
+    picks = np.empty((1<<rounds) - 1, dtype=int)
+    picks[0] = levels[0][0].argmax()
+    for g in xrange(1, len(picks)):
+        depth = int(np.log2(g+1))
+        k = g - (1<<depth) + 1
+        winner = picks[(g-1)>>1]
+        if levels[depth][k, winner] > -np.inf:
+            # Winner of the parent game comes from this subtree
+            picks[g] = winner
+        else:
+            picks[g] = levels[depth][k].argmax()
+
+    expected = levels[0][0].max()
+    picks[picks==n] = -1
+    return picks, expected
+
+
+def _with_bye(probs):
+    '''Probability matrix with an extra last row and column for byes. Byes
+    lose to everyone, and a game between two byes yields a bye.'''
+    n = len(probs)
+    p = np.zeros((n+1, n+1))
+    p[:n, :n] = probs
+    p[:n, n] = 1.
+    return p
+
+
+def tournament_leaves(tournament):
+    '''Squads entering a Tournament's bracket, as the 2^R leaves below its R
+    rounds, in heap order (None for byes). Works on empty brackets as well
+    as on filled in ones, whose first round Games also list the Squads that
+    advanced from the play-in round.
+
+    Without a play-in round, the leaves are the opponents of the first
+    round Games. With one, the leaves are the opponents of the play-in
+    Games; Squads that go straight to the first round are put into an empty
+    play-in Game below their first round Game, against a bye.'''
+    R = len(tournament.rounds)
+    offset = (1<<R) - 1
+    leaves = [None] * (1<<R)
+
+    def _fill(game, squads):
+        for k, squad in enumerate(squads):
+            leaves[2*game + 1 + k - offset] = squad
+
+    last = (1<<(R-1)) - 1
+    if not tournament.playin:
+        for g in xrange(last, 2*last+1):
+            ops = list(tournament[g].opponents)
+            if len(ops)>2:
+                raise ValueError("%d opponents in game %d" % (len(ops), g))
+            _fill(g, ops)
+        return leaves
+
+    first = (1<<(R-2)) - 1
+    for g in xrange(first, 2*first+1):
+        direct = list(tournament[g].opponents)
+        free = []
+        for c in (2*g+1, 2*g+2):
+            playin = list(tournament[c].opponents)
+            if len(playin)==2:
+                _fill(c, playin)
+                direct = [s for s in direct if s not in playin]
+            else:
+                free.append(c)
+        if len(direct)>len(free):
+            raise ValueError("Too many opponents in game %d" % g)
+        for c, squad in zip(free, direct):
+            _fill(c, [squad])
+    return leaves
@@ -12,142 +12,344 @@ __date__="March 18, 2013"
 
 
 from ncaa import *
+from views import SquadRegistry, SquadView, StatsView
+from bracket import Bracket, BracketScorer
+from frame import or_missing, to_int, to_float
 from aux.output import print_warning
-import copy
+from multiprocessing import Pool, current_process
 import numbers
 import time
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
 import numpy as np
 
 
 
 
 
-class ExtractedSquad(object):
-    '''Analogous to Squad in ncaa module but not connected to DB. Only copies
-    the bare minimum for simulation.'''
-    def __init__(self, squad):
-        self.id = squad.id
-        self.stats = copy.deepcopy(squad.stats)
-        self.lsalpha = squad.lsalpha
-        self.rpi = squad.rpi
-        self.wp = squad.win_pct(weighted=False)
-        self.wwp = squad.win_pct(weighted=True)
-
-
-
-
-
-
-class ExtractedTournamentGame(object):
-    '''Analogous to TournamentGame in the ncaa module, but not connected
-    to database at all and optimized for multiple simulations and scorings.'''
-    def __init__(self, game):
-        if game.opponents is None:
-            self.opponents = None
-        else:
-            self.opponents = [ExtractedSquad(s) for s in game.opponents]
-
-        self.winner = ExtractedSquad(game.winner)
-        self.loser = ExtractedSquad(game.loser)
-        
-
-
-
-
-
 class ExtractedTournament(object):
     '''Analogous to Tournament in ncaa module, but not connected to database.
     Optimized for repeatedly performing simulations. Used in grid searches
-    for maximizing expected Tournament score.'''
-    def __init__(self, tournament, scoring=None):
-        self.games = [ExtractedTournamentGame(tg) for tg in tournament.games]
-        self.key = [tg.winner.id for tg in self.games]
-        
+    for maximizing expected Tournament score.
+
+    The bracket is a Bracket (see ncaalib.bracket) whose games refer to
+    Squads by their number in a SquadRegistry, where each Squad is extracted
+    once as a read-only SquadView. Pass squads (a SquadRegistry) to share
+    one between Tournaments; the Tournament's season is loaded into it if
+    needed.'''
+    def __init__(self, tournament, scoring=None, squads=None):
+        if squads is None:
+            squads = SquadRegistry()
+        squads.load(object_session(tournament), tournament.season)
+        self.squads = squads
+
+        bracket = Bracket.from_tournament(tournament, squads.views,
+                                          squads.rows)
         if scoring is None:
-            self.scoremap = tournament.roundpoints
-        else:
-            self.scoremap = scoring
-            
-        self._gtype = type(self.games[0])
-        self._stype = type(self.games[0].opponents[0])
-        self._predicted_ids = None
-    
+            scoring = tournament.roundpoints
+        self._setup(bracket, scoring)
+
+    @classmethod
+    def from_bundle(cls, bundle, i, views=None):
+        '''The i-th Tournament of a TournamentBundle, without a DB. Pass
+        views (from bundle.views()) when extracting several, to share
+        them.'''
+        if views is None:
+            views = bundle.views()
+        meta = bundle.tournaments[i]
+        lo, hi = bundle.arrays['leaf_offsets'][i:i+2]
+        bracket = Bracket(meta['season'], views, bundle.arrays['leaves'][lo:hi],
+                          meta['rounds'], meta['regions'],
+                          delim=meta['delim'], playin=meta['playin'],
+                          id=meta['id'])
+        lo, hi = bundle.arrays['game_offsets'][i:i+2]
+        bracket.winners[:] = bundle.arrays['key'][lo:hi]
+
+        extracted = object.__new__(cls)
+        extracted.squads = None
+        extracted._setup(bracket, meta['scoremap'])
+        return extracted
+
+    def _setup(self, bracket, scoremap):
+        '''Take bracket, filled in with the real results, as the key.'''
+        self.bracket = bracket
+        self.key = [bracket.squads[r].id if r>=0 else None
+                        for r in bracket.winners]
+        self.scoremap = scoremap
+
+        self._scorer = BracketScorer(bracket.winners, scoremap)
+        self._correct = None
+
+    @property
+    def games(self):
+        return self.bracket.games
+
     def __iter__(self):
-        return TournamentIterator(self)
+        return iter(self.bracket)
     
     def score(self):
-        pkey = []
-        s = 0
-        for i, game in enumerate(self.games):
-            id_ = game.winner.id
-            if self.key[i]==id_:
-                round_ = log2(i+1)
-                s += self.scoremap[round_]
-            pkey.append(id_)
-        self._predicted_ids = pkey
-        return s
+        scores, correct = self._scorer.score(self.bracket.winners)
+        self._correct = correct[0]
+        return scores[0].item()
 
     def clear_bracket(self):
-        sr_id = len(self.games)>>1
-        for i in range(sr_id):
-            self.games[i].opponents = []
-            self.games[i].winner = self.games[i].loser = None
-        for i in range(len(self.games)-1, sr_id-1, -1):
-            self.games[i].winner = None
-            self.games[i].loser = None
+        self.bracket.clear()
 
     def correct_in_round(self, k):
         '''Return % correctly predicted winners in round k'''
-        game_ids = range((1<<k)-1, (1<<(k+1))-1)
-        den = float(len(game_ids))
-        key = self.key
-        
-        if self._predicted_ids is None:
+        if self._correct is None:
             self.score()
-        
-        pids = self._predicted_ids
-        
-        return sum([key[i]==pids[i] for i in game_ids], 0.) / den
+        return self._correct[k] / float(1<<k)
     
     def test(self, decider):
-        self.clear_bracket()
-        len_ = len(self.games) - 1
-        for _x_, tgame in enumerate(self):
-            _i_ = len_ - _x_
-            if len(tgame.opponents)!=2:
-                raise IndexError("%d opponents in game %d" \
-                                    % (len(tgame.opponents), _i_))
-            r = decider(tgame)
-            if type(r) is self._gtype:
-                tgame = r
-                if tgame.winner is None or tgame.loser is None:
-                    raise ValueError("Winner / loser not set on returned Game.")
-            elif type(r) is tuple or type(r) is list:
-                tgame.winner = r[0]
-                tgame.loser = r[1]
-            elif type(r) is self._stype:
-                tgame.winner = r
-                lid = (tgame.opponents.index(r)+1)%2
-                tgame.loser = tgame.opponents[lid]
-            elif type(r) is int:
-                tgame.winner = tgame.opponents[r]
-                tgame.loser = tgame.opponents[(r+1)%2]
-            elif type(r) is np.ndarray or type(r) is list:
-                i = int(r[0])
-                tgame.winner = tgame.opponents[i]
-                tgame.loser = tgame.opponents[(i+1)%2]
-            else:
-                raise NotImplementedError("Unsupported return type %s"\
-                                            % type(r))
+        '''Simulate the bracket with decider, a round at a time, and score
+        it. See Bracket.simulate.'''
+        self.bracket.simulate(decider)
+        return self.score()
 
-            next_id = ((_i_+1) >> 1) - 1
-            if next_id < 0:
-                next_id = None
-            
-            if next_id is not None:
-                self.games[next_id].opponents.append(tgame.winner)
 
-        return self.score()
+
+
+class TournamentBundle(object):
+    '''The data of a set of ExtractedTournaments as numpy arrays, which can
+    be saved as a directory of .npy files and attached to, memory-mapped,
+    by other processes without copying them (see TournamentScorer).
+
+    The Squads in the brackets are numbered. Per Squad arrays hold their
+    SquadView attributes (-1 / NaN / '' for None) and 'stats' their
+    derived stats, with columns StatsView.fields. 'leaves' and 'key' hold,
+    for all Tournaments one after the other, the Squads entering each
+    bracket and the real winner of each game (-1 for none); each
+    Tournament's part starts at 'leaf_offsets' and 'game_offsets'. The
+    layout of each Tournament is in tournaments. Pickling a saved bundle
+    only pickles its path.
+
+    Bundles can also be kept in a cache directory, under a key made from
+    info, a dict of what they were built from (see cached and
+    save_cache).'''
+
+    version = 2
+
+    squad_ints = ('id', 'team_id', 'seed', 'rank')
+    squad_floats = ('rpi', 'lsalpha', 'wp', 'wwp', 'pwwp')
+    squad_strings = ('season', 'name', 'conference')
+
+    def __init__(self, arrays, tournaments, path=None, info=None):
+        self.arrays = arrays
+        self.tournaments = tournaments
+        self.path = path
+        self.info = info or dict()
+
+    @classmethod
+    def from_tournaments(cls, extracted):
+        '''Bundle a list of ExtractedTournaments.'''
+        views = []
+        rows = dict()
+        leaves, key = [], []
+        leaf_offsets, game_offsets = [0], [0]
+        tournaments = []
+        for et in extracted:
+            bracket = et.bracket
+            renumber = np.empty(len(bracket.squads)+1, dtype=int)
+            renumber[-1] = -1
+            for r in set(bracket.leaves[bracket.leaves>=0]):
+                view = bracket.squads[r]
+                if view.id not in rows:
+                    rows[view.id] = len(views)
+                    views.append(view)
+                renumber[r] = rows[view.id]
+
+            leaves.append(renumber[bracket.leaves])
+            key.append(renumber[et._scorer.actual])
+            leaf_offsets.append(leaf_offsets[-1] + len(bracket.leaves))
+            game_offsets.append(game_offsets[-1] + len(bracket))
+            tournaments.append(dict(id=bracket.id,
+                                    season=bracket.season,
+                                    rounds=bracket.rounds,
+                                    regions=bracket.regions,
+                                    delim=bracket.delim,
+                                    playin=bracket.playin,
+                                    scoremap=list(et.scoremap)))
+
+        arrays = dict()
+        for attr in cls.squad_ints:
+            arrays[attr] = np.array([or_missing(getattr(v, attr), -1)
+                                        for v in views], dtype=int)
+        for attr in cls.squad_floats:
+            arrays[attr] = np.array([or_missing(getattr(v, attr), np.nan)
+                                        for v in views], dtype=float)
+        for attr in cls.squad_strings:
+            arrays[attr] = np.array([unicode(or_missing(getattr(v, attr), ''))
+                                        for v in views], dtype=unicode)
+
+        arrays['has_stats'] = np.array([v.stats is not None for v in views],
+                                       dtype=bool)
+        arrays['stats'] = np.array([[or_missing(getattr(v.stats, f, None),
+                                                np.nan)
+                                        for f in StatsView.fields]
+                                            for v in views], dtype=float)\
+                            .reshape(len(views), len(StatsView.fields))
+        arrays['leaves'] = np.concatenate(leaves)
+        arrays['key'] = np.concatenate(key)
+        arrays['leaf_offsets'] = np.array(leaf_offsets, dtype=int)
+        arrays['game_offsets'] = np.array(game_offsets, dtype=int)
+        return cls(arrays, tournaments)
+
+    def add_features(self, features):
+        '''Add the features of every ordered pair of Squads that can meet in
+        one of the brackets, with features(a, b) called on SquadViews, as
+        one (pairs x features) array 'features'. 'pair_index' is the
+        (squads x squads) array of the row of each pair (-1 for none).
+        Nothing is added, and False returned, unless all features are 1-d
+        arrays of the same length.'''
+        views = self.views()
+        index = -np.ones((len(views), len(views)), dtype=int)
+        rows = []
+        offsets = self.arrays['leaf_offsets']
+        for i in xrange(len(self.tournaments)):
+            leaves = self.arrays['leaves'][offsets[i]:offsets[i+1]]
+            field = sorted(set(leaves[leaves>=0]))
+            for a in field:
+                for b in field:
+                    if a!=b and index[a, b]<0:
+                        index[a, b] = len(rows)
+                        rows.append(features(views[a], views[b]))
+
+        if not rows or not all(type(ft) is np.ndarray and ft.ndim==1
+                                and len(ft)==len(rows[0]) for ft in rows):
+            return False
+        self.arrays['features'] = np.vstack(rows)
+        self.arrays['pair_index'] = index
+        return True
+
+    def save(self, path):
+        '''Save as .npy files plus bundle.json in directory path, which is
+        created if needed. Returns self.'''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name, array in self.arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        with open(os.path.join(path, 'bundle.json'), 'w') as fh:
+            json.dump({'version': self.version,
+                       'arrays': sorted(self.arrays.keys()),
+                       'tournaments': self.tournaments,
+                       'info': self.info}, fh)
+        self.path = path
+        return self
+
+    def copy(self):
+        '''Unsaved bundle with the same arrays, to add to.'''
+        return TournamentBundle(dict(self.arrays), self.tournaments,
+                                info=dict(self.info))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''Attach to a bundle saved in path. Arrays are memory-mapped unless
+        mmap_mode is None. Raises ValueError if the bundle was saved by
+        another version.'''
+        with open(os.path.join(path, 'bundle.json')) as fh:
+            meta = json.load(fh)
+        if meta.get('version')!=cls.version:
+            raise ValueError("Bundle in %s has version %s, need %s" \
+                                % (path, meta.get('version'), cls.version))
+        arrays = dict((name, np.load(os.path.join(path, name + '.npy'),
+                                     mmap_mode=mmap_mode))
+                        for name in meta['arrays'])
+        return cls(arrays, meta['tournaments'], path, meta.get('info'))
+
+    @classmethod
+    def cache_key(cls, info):
+        '''Name of the cache entry of a bundle built from info.'''
+        info = dict(info, version=cls.version)
+        return hashlib.md5(json.dumps(info, sort_keys=True)).hexdigest()
+
+    @classmethod
+    def cached(cls, cache_dir, info):
+        '''The bundle built from info in cache_dir, or None if there is
+        none (or it is from another version).'''
+        path = os.path.join(cache_dir, cls.cache_key(info))
+        if not os.path.exists(os.path.join(path, 'bundle.json')):
+            return None
+        try:
+            return cls.load(path)
+        except ValueError:
+            return None
+
+    @classmethod
+    def find(cls, cache_dir, **info):
+        '''Keys of the bundles in cache_dir whose info has the given items,
+        e.g. seasons, whatever else they were built from. Most recently
+        cached first.'''
+        found = []
+        for name in os.listdir(cache_dir):
+            meta = os.path.join(cache_dir, name, 'bundle.json')
+            if not os.path.exists(meta):
+                continue
+            with open(meta) as fh:
+                saved = json.load(fh)
+            if saved.get('version')!=cls.version:
+                continue
+            if all(saved.get('info', {}).get(k)==v for k, v in info.items()):
+                found.append((os.path.getmtime(meta), name))
+        return [name for mtime, name in sorted(found, reverse=True)]
+
+    def save_cache(self, cache_dir):
+        '''Save in cache_dir under the key of self.info. The bundle is
+        written to a temporary directory first and then renamed, so other
+        processes never see half a bundle. Returns self, attached to the
+        cache entry.'''
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        path = os.path.join(cache_dir, self.cache_key(self.info))
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=cache_dir)
+        self.save(tmp)
+        shutil.rmtree(path, True)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # Another process got there first; theirs is as good
+            shutil.rmtree(tmp, True)
+        self.path = path
+        return self
+
+    def views(self):
+        '''SquadViews of the Squads in the bundle, in order.'''
+        a = self.arrays
+        views = []
+        for i in xrange(len(a['id'])):
+            values = dict()
+            for attr in self.squad_ints:
+                values[attr] = to_int(a[attr][i])
+            for attr in self.squad_floats:
+                values[attr] = to_float(a[attr][i])
+            for attr in self.squad_strings:
+                values[attr] = unicode(a[attr][i]) or None
+            if a['has_stats'][i]:
+                values['stats'] = StatsView([to_float(v)
+                                                 for v in a['stats'][i]])
+            views.append(SquadView(**values))
+        return views
+
+    def extracted(self):
+        '''ExtractedTournaments of the bundle.'''
+        views = self.views()
+        return [ExtractedTournament.from_bundle(self, i, views)
+                    for i in xrange(len(self.tournaments))]
+
+    def __getstate__(self):
+        if self.path is None:
+            return self.__dict__.copy()
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        if 'arrays' in state:
+            self.__dict__.update(state)
+        else:
+            self.__dict__.update(self.load(state['path']).__dict__)
 
 
 
@@ -170,22 +372,113 @@ class TournamentScorer(object):
     In maximizing overall bracket score, you can specify the scoring parameter
     to provide a specific number of points to rounds (again, with the 0th item
     being the Championship and 5th being the Round of 64). By default the
-    ESPN scoring system which assigns 320 max points to each round is used.'''
+    ESPN scoring system which assigns 320 max points to each round is used.
+
+    The features of every pair of Squads that can meet in the brackets are
+    extracted (and normalized) once, when the scorer is made, if the
+    extractor returns 1-d arrays. Scoring an estimator then takes one call
+    to its predict method (or `method`) over all of them, after which the
+    brackets are filled in from the decisions. Otherwise (e.g. with NLTK
+    feature dicts) the estimator is run game by game through a GameDecider,
+    in n_jobs processes, which is much slower; a warning is printed when
+    the scorer is made.
+
+    Pass cache_dir to keep the extracted Tournaments there, keyed by the
+    seasons, the scoring and the version of the DB (the size and
+    modification time of the file, and the row counts and highest IDs of
+    its main tables), so that the next scorer made from the same DB only
+    runs a few aggregate queries on it. The key is kept as cache_key.
+    from_cache makes a scorer from the cache alone, without a DB.'''
     def __init__(self, session,
                        extractor,
                        round_ = None,
                        scoring = None,
                        seasons=['2009-10', '2010-11', '2011-12'],
                        normalize=None, method=None,
-                       greater_is_better=True):
-        
+                       greater_is_better=True,
+                       n_jobs=1, bundle_dir=None, cache_dir=None):
+
         self.seasons = seasons
         #self._session = session   # NOTE: Don't save session, otherwise
                                    # object will not be picklable (and so
                                    # it can't be parallelized)
+        self._configure(extractor, round_, normalize, method,
+                        greater_is_better, n_jobs)
+
+        # The extracted Tournaments only depend on the DB, so they can be
+        # reused from the cache as long as the DB file is unchanged
+        bundle = None
+        self.cache_key = None
+        if cache_dir is not None:
+            info = _cache_info(seasons, scoring, _database_version(session))
+            self.cache_key = TournamentBundle.cache_key(info)
+            bundle = TournamentBundle.cached(cache_dir, info)
+
+        if bundle is None:
+            tournaments = session.query(Tournament)\
+                                 .filter(Tournament.season.in_(seasons))\
+                                 .all()
+            # Squads are extracted once for all seasons
+            squads = SquadRegistry()
+            extracted = [ExtractedTournament(t, scoring, squads)
+                            for t in tournaments]
+            bundle = TournamentBundle.from_tournaments(extracted)
+            if cache_dir is not None:
+                bundle.info = info
+                bundle.save_cache(cache_dir)
+
+        self._attach(bundle, bundle_dir)
+
+    @classmethod
+    def from_cache(cls, cache_dir,
+                        extractor,
+                        round_=None,
+                        scoring=None,
+                        seasons=['2009-10', '2010-11', '2011-12'],
+                        normalize=None, method=None,
+                        greater_is_better=True,
+                        n_jobs=1, bundle_dir=None, key=None):
+        '''Make a scorer without a DB, from the Tournaments of seasons that
+        a scorer made with the same cache_dir and scoring has extracted.
+        Raises IOError if there are none.
+
+        Without the DB there is no telling which DB the cached Tournaments
+        came from: unless key is given, the most recently cached ones are
+        used, whatever DB they were extracted from, and a warning is printed
+        if Tournaments from more than one version of the DB are cached. Pass
+        key (the cache_key of a scorer made with cache_dir) to use exactly
+        those.'''
+        info = _cache_info(seasons, scoring, None)
+        del info['database']
+        found = []
+        if os.path.isdir(cache_dir):
+            found = TournamentBundle.find(cache_dir, **info)
+        if key is not None:
+            found = [name for name in found if name==key]
+        if not found:
+            raise IOError("No cached Tournaments of %s in %s" \
+                            % (", ".join(seasons), cache_dir))
+        if len(found)>1:
+            print_warning("Tournaments of %s from %d versions of the DB are "
+                          "cached in %s; using the latest (%s)." \
+                            % (", ".join(seasons), len(found), cache_dir,
+                               found[0]))
+        bundle = TournamentBundle.load(os.path.join(cache_dir, found[0]))
+
+        self = cls.__new__(cls)
+        self.seasons = seasons
+        self.cache_key = found[0]
+        self._configure(extractor, round_, normalize, method,
+                        greater_is_better, n_jobs)
+        self._attach(bundle, bundle_dir)
+        return self
+
+    def _configure(self, extractor, round_, normalize, method,
+                         greater_is_better, n_jobs):
+        '''Set the options that don't depend on the Tournaments.'''
         self.extractor = extractor
         self.normalize = normalize
-        
+
         try:
             # Is round_ iterable?
             it = iter(round_)
@@ -203,39 +496,135 @@ class TournamentScorer(object):
         else:
             # round_ is iterable
             self.round_ = round_
-        
+
         if round_ is not None:
             self._rounds_frac = 1. / float(len(self.round_))
-        
+
         self.method = method
         self.greater_is_better = greater_is_better
-        tournaments = session.query(Tournament)\
-                             .filter(Tournament.season.in_(seasons))\
-                             .all()
-        self.tournaments = [ExtractedTournament(t,scoring) for t in tournaments]
+        self.n_jobs = n_jobs
+
+    def _attach(self, bundle, bundle_dir=None):
+        '''Add the pair features to (a copy of) bundle and use it. The
+        extracted Tournaments are kept in a memory-mapped bundle, which is
+        all that is pickled to worker processes (e.g. by GridSearchCV).'''
+        if bundle_dir is None:
+            bundle_dir = tempfile.mkdtemp(prefix='ncaa-scorer-')
+            atexit.register(shutil.rmtree, bundle_dir, True)
+        bundle = bundle.copy()
+        if not bundle.add_features(self.features):
+            print_warning("Features aren't 1-d arrays of the same length; "
+                          "TournamentScorer will classify game by game.")
+        bundle.save(bundle_dir)
+        self.bundle = TournamentBundle.load(bundle_dir)
+        self.tournaments = self.bundle.extracted()
+
         self._len = float(len(self.tournaments))
         self._frac = 1. / self._len
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['tournaments']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tournaments = self.bundle.extracted()
+
     def __call__(self, estimator, *args):
         '''To implement the scorer protocol __call__ must accept X, y as 
         the testing set. The whole point of this scorer is to bring a
         specialized test set, though, so whatever is provided for X and y
         should just be ignored.'''
-        decider = GameDecider(estimator, self.extractor,
-                              normalize=self.normalize, method=self.method)
-        round_ = self.round_
-        trns = self.tournaments
+        if 'features' in self.bundle.arrays:
+            # Decide every pairing at once, then fill in the brackets
+            decider = self.pair_decider(estimator)
+            results = [self.test(decider, i)
+                            for i in xrange(len(self.tournaments))]
+            return self._combine(results)
+
+        tasks = [(self, estimator, i) for i in xrange(len(self.tournaments))]
+        if self.n_jobs==1 or len(tasks)<2 or current_process().daemon:
+            # Serial; also inside a worker, which can't have its own workers
+            results = map(_test_tournament, tasks)
+        else:
+            pool = Pool(self.n_jobs if self.n_jobs>0 else None)
+            try:
+                results = pool.map(_test_tournament, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        return self._combine(results)
+
+    def _combine(self, results):
+        '''Overall score from the results of test for each Tournament.'''
         f = self._frac
         rf = self._rounds_frac
-        
-        s = sum([f * t.test(decider) for t in trns])
-
-        if round_ is None:
-            return s
+        if self.round_ is None:
+            return sum([f * s for s, correct in results])
+        else:
+            return sum([f * rf * c for s, correct in results
+                                        for c in correct])
+
+    def test(self, estimator, i):
+        '''Score of estimator in the i-th Tournament, and the fraction of
+        correct picks in each of the rounds in round_. estimator may also be
+        a decision function, e.g. from pair_decider.'''
+        if hasattr(estimator, 'decide_many'):
+            decider = estimator
         else:
-            return sum([f * rf * t.correct_in_round(r)
-                                                    for t in trns
-                                                            for r in round_])
+            decider = GameDecider(estimator, self.extractor,
+                                  normalize=self.normalize,
+                                  method=self.method)
+        t = self.tournaments[i]
+        s = t.test(decider)
+        return s, [t.correct_in_round(r) for r in (self.round_ or [])]
+
+    def features(self, a, b):
+        '''Features of Squad a against Squad b, as GameDecider makes them.'''
+        ft = self.extractor(a, b)
+        if self.normalize is not None:
+            ft = self.normalize(ft)
+        return ft
+
+    def pair_decider(self, estimator):
+        '''PairDecider with estimator's decisions for every pairing in the
+        bundle, made with one call, to the method GameDecider would use.'''
+        method = GameDecider(estimator, self.extractor,
+                             normalize=self.normalize,
+                             method=self.method).method
+        labels = method(self.bundle.arrays['features'])
+        return PairDecider(np.asarray(labels).astype(int),
+                           self.bundle.arrays['pair_index'])
+
+
+
+
+class PairDecider(object):
+    '''Decision function that looks up decisions made in advance for pairs
+    of Squads, e.g. by TournamentScorer.pair_decider. wins[pair_index[a, b]]
+    is the index of the winner (0 for a, 1 for b) when Squad a plays Squad
+    b, with Squads numbered as in a TournamentBundle.'''
+    def __init__(self, wins, pair_index):
+        self.wins = wins
+        self.pair_index = pair_index
+
+    def __call__(self, game):
+        return self.decide_many([game])[0]
+
+    def decide_many(self, games):
+        '''Decisions for Games of ExtractedTournaments made from the same
+        TournamentBundle.'''
+        ret = []
+        for game in games:
+            rows = game.bracket._rows
+            a, b = [rows[s.id] for s in game.opponents]
+            pair = self.pair_index[a, b]
+            if pair < 0:
+                raise KeyError("No decision for %s vs. %s" % (a, b))
+            ret.append(int(self.wins[pair]))
+        return ret
             
 
 
@@ -244,6 +633,44 @@ class TournamentScorer(object):
 
 
 
+# -- HELPER FUNCTIONS -- //
+def _test_tournament(task):
+    '''Test an estimator on one of a TournamentScorer's Tournaments. Module
+    level so that it can be run by multiprocessing.'''
+    scorer, estimator, i = task
+    return scorer.test(estimator, i)
+
+
+def _cache_info(seasons, scoring, database):
+    '''What the extracted Tournaments of a TournamentScorer are built from,
+    as the info of their TournamentBundle.'''
+    return {'seasons': sorted(seasons),
+            'scoring': None if scoring is None else list(scoring),
+            'database': database}
+
+
+def _database_version(session):
+    '''Cheap fingerprint of the SQLite file session is connected to: its
+    size and modification time, and the number of rows and highest ID of
+    the tables Tournaments are extracted from. Any write changes it.'''
+    path = session.get_bind().url.database
+    if not path or not os.path.exists(path):
+        raise ValueError("Can only cache Tournaments of a database file")
+    st = os.stat(path)
+    parts = [st.st_size, repr(st.st_mtime)]
+    for cls in (Tournament, Squad, SquadMember, Game):
+        t = cls.__table__
+        parts += list(session.execute(select([func.count(t.c.id),
+                                              func.max(t.c.id)])).first())
+    return ','.join(str(p) for p in parts)
+
+
+
+
+
+
+
+
 if __name__=='__main__':
     from sys import argv, exit
     from aux.output import print_error, print_info, print_success, print_comment
@@ -0,0 +1,345 @@
+#-*- coding: utf8 -*-
+'''
+ncaalib.frame
+
+Bulk, read-only snapshot of a season for batch computations.
+
+Walking Squad.schedule, Game.opponents, Squad.wins / losses, rosters and
+statsheets through the ORM issues a SELECT for every collection touched. A
+SeasonFrame instead loads one season's teams, squads, games, schedule rows,
+squad members and statsheets in a handful of set-based queries and stores
+them in numpy arrays, with dicts mapping DB IDs to array rows.
+
+All Squads, Games, SquadMembers and statsheets are referred to by their row
+in the frame's arrays, never by ORM object. Use squad() / game() to go from
+an ID to a row, and squad_ids / game_ids to go back.
+
+Copyright (c) 2013 Joe Nudell.
+Freely distributable under the MIT License.
+'''
+
+from ncaa import *
+import numpy as np
+
+
+
+
+class SeasonFrame(object):
+    '''Snapshot of all the data for Squads in a given season. Answers the same
+    questions as the ORM (a Squad's games, wins, losses and opponents, box
+    score totals) with array operations.
+
+    Arrays are aligned as follows:
+
+        Squads      squad_ids, team_ids, team_names, seeds, rpi, lsalpha,
+                    conference, rank
+        Games       game_ids, dates, winner, loser, winner_score,
+                    loser_score, postseason, overtime, arena, matchups
+        Members     member_ids, member_squad, member_player
+        Statsheets  sheet_ids, sheet_member, sheet_game, sheet_stats
+
+    winner, loser, matchups and member_squad hold Squad rows (-1 if the
+    Squad is unknown or is not in this season). matchups is a (games x 2)
+    array; games that don't have exactly two Squads in the season have -1 in
+    both columns. sheet_stats has one column per PlayerStatSheet.stats, with
+    N/A values stored as NaN.
+
+    Pass statsheets=False to skip loading members and statsheets, which are
+    by far the biggest part of a season, when only results are needed.'''
+
+    # Columns of sheet_stats and of box score totals
+    stats = PlayerStatSheet.stats
+
+    def __init__(self, session, season, statsheets=True):
+        self.season = season
+        self._session = session
+
+        self._load_squads()
+        self._load_games()
+        self._load_schedule()
+
+        self.has_statsheets = statsheets
+        if statsheets:
+            self._load_statsheets()
+
+    ## Loading
+
+    def _load_squads(self):
+        '''One query for the season's Squads and their Teams.'''
+        squad = Squad.__table__
+        team = Team.__table__
+
+        q = select([squad.c.id, squad.c.team_id, team.c.name, squad.c.seed,
+                    squad.c.rpi, squad.c.lsalpha, squad.c.conference,
+                    squad.c.rank])\
+              .select_from(squad.outerjoin(team, team.c.id==squad.c.team_id))\
+              .where(squad.c.season==self.season)\
+              .order_by(squad.c.id)
+        rows = self._session.execute(q).fetchall()
+
+        self.squad_ids = _ints([r[0] for r in rows])
+        self.team_ids = _ints([r[1] for r in rows])
+        self.team_names = np.array([r[2] for r in rows], dtype=object)
+        self.seeds = _ints([r[3] for r in rows])
+        self.rpi = _floats([r[4] for r in rows])
+        self.lsalpha = _floats([r[5] for r in rows])
+        self.conference = np.array([r[6] for r in rows], dtype=object)
+        self.rank = _ints([r[7] for r in rows])
+
+        self.squad_index = dict((sid, i) for i, sid
+                                            in enumerate(self.squad_ids))
+
+    def _season_games(self):
+        '''Subquery selecting IDs of Games any Squad in season is in.'''
+        squad = Squad.__table__
+        return select([schedule.c.game_id])\
+                 .select_from(schedule.join(squad,
+                                            squad.c.id==schedule.c.squad_id))\
+                 .where(squad.c.season==self.season)
+
+    def _load_games(self):
+        '''One query for every Game in the season.'''
+        game = Game.__table__
+
+        q = select([game.c.id, game.c.date, game.c.winner_id,
+                    game.c.loser_id, game.c.winner_score, game.c.loser_score,
+                    game.c.postseason, game.c.overtime, game.c.arena])\
+              .where(game.c.id.in_(self._season_games()))\
+              .order_by(game.c.id)
+        rows = self._session.execute(q).fetchall()
+
+        self.game_ids = _ints([r[0] for r in rows])
+        self.dates = np.array([r[1] for r in rows], dtype=object)
+        self.winner = self._squad_rows(_ints([r[2] for r in rows]))
+        self.loser = self._squad_rows(_ints([r[3] for r in rows]))
+        self.winner_score = _ints([r[4] for r in rows])
+        self.loser_score = _ints([r[5] for r in rows])
+        self.postseason = np.array([bool(r[6]) for r in rows], dtype=bool)
+        self.overtime = _ints([r[7] for r in rows])
+        self.arena = np.array([r[8] for r in rows], dtype=object)
+
+        # Date ordinals, for ordering schedules. Unknown dates go first, like
+        # NULLs do in SQLite.
+        self._ordinals = _ints([-1 if d is None else d.toordinal()
+                                    for d in self.dates])
+
+        self.game_index = dict((gid, i) for i, gid
+                                            in enumerate(self.game_ids))
+
+    def _load_schedule(self):
+        '''One query for the schedule rows of every Squad in the season.
+        Stored CSR-style: the games of Squad row i are
+        _sched_games[_sched_start[i]:_sched_start[i+1]], ordered by date.'''
+        squad = Squad.__table__
+
+        q = select([schedule.c.game_id, schedule.c.squad_id, schedule.c.type])\
+              .select_from(schedule.join(squad,
+                                         squad.c.id==schedule.c.squad_id))\
+              .where(squad.c.season==self.season)\
+              .order_by(schedule.c.game_id, schedule.c.squad_id)
+        rows = self._session.execute(q).fetchall()
+
+        games = self._game_rows(_ints([r[0] for r in rows]))
+        squads = self._squad_rows(_ints([r[1] for r in rows]))
+        types = np.array([r[2] for r in rows], dtype=object)
+
+        # Pair up opponents of each Game
+        n = len(self.game_ids)
+        self.matchups = -np.ones((n, 2), dtype=int)
+        counts = np.bincount(games, minlength=n)
+        if len(games):
+            first = np.searchsorted(games, np.arange(n))
+            pair = np.flatnonzero(counts==2)
+            self.matchups[pair, 0] = squads[first[pair]]
+            self.matchups[pair, 1] = squads[first[pair]+1]
+            self.matchups[self.matchups[:, 0]==self.matchups[:, 1]] = -1
+
+        # Order by squad, then date, then game
+        order = np.lexsort((games, self._ordinals[games], squads))
+        self._sched_games = games[order]
+        self._sched_type = types[order]
+        self._sched_start = np.searchsorted(squads[order],
+                                            np.arange(len(self.squad_ids)+1))
+
+    def _load_statsheets(self):
+        '''Two queries: one for SquadMembers, one for their statsheets.'''
+        squad = Squad.__table__
+        member = SquadMember.__table__
+        sheet = PlayerStatSheet.__table__
+
+        q = select([member.c.id, member.c.squad_id, member.c.player_id])\
+              .select_from(member.join(squad, squad.c.id==member.c.squad_id))\
+              .where(squad.c.season==self.season)\
+              .order_by(member.c.id)
+        rows = self._session.execute(q).fetchall()
+
+        self.member_ids = _ints([r[0] for r in rows])
+        self.member_squad = self._squad_rows(_ints([r[1] for r in rows]))
+        self.member_player = _ints([r[2] for r in rows])
+        self.member_index = dict((mid, i) for i, mid
+                                            in enumerate(self.member_ids))
+
+        cols = [getattr(sheet.c, stat) for stat in self.stats]
+        q = select([sheet.c.id, sheet.c.squadmember_id, sheet.c.game_id]+cols)\
+              .select_from(sheet.join(member,
+                                      member.c.id==sheet.c.squadmember_id)\
+                                .join(squad, squad.c.id==member.c.squad_id))\
+              .where(squad.c.season==self.season)\
+              .order_by(sheet.c.id)
+        rows = self._session.execute(q).fetchall()
+
+        self.sheet_ids = _ints([r[0] for r in rows])
+        self.sheet_member = _rows(self.member_ids,
+                                  _ints([r[1] for r in rows]))
+        self.sheet_game = self._game_rows(_ints([r[2] for r in rows]))
+        self.sheet_stats = np.array([r[3:] for r in rows], dtype=float)\
+                             .reshape(len(rows), len(self.stats))
+
+        self._box = None
+
+    def _squad_rows(self, ids):
+        return _rows(self.squad_ids, ids)
+
+    def _game_rows(self, ids):
+        return _rows(self.game_ids, ids)
+
+    ## Lookups
+
+    def squad(self, sid):
+        '''Row of Squad with given ID'''
+        return self.squad_index[sid]
+
+    def game(self, gid):
+        '''Row of Game with given ID'''
+        return self.game_index[gid]
+
+    def __len__(self):
+        return len(self.squad_ids)
+
+    ## Squad questions. All take a Squad row, like Squad's methods.
+
+    def schedule(self, i):
+        '''All Games of Squad row i, ordered by date. This is a view.'''
+        return self._sched_games[self._sched_start[i]:self._sched_start[i+1]]
+
+    def games(self, i, postseason=False, played=True):
+        '''Games of Squad row i. Same semantics as Squad.get_games.'''
+        games = self.schedule(i)
+        mask = np.ones(len(games), dtype=bool)
+        if not postseason:
+            mask &= ~self.postseason[games]
+        if played:
+            mask &= self.winner[games]>=0
+        return games[mask]
+
+    def wins(self, i, postseason=False):
+        '''Games won by Squad row i. Same semantics as Squad.get_wins.'''
+        games = self.games(i, postseason=postseason, played=False)
+        return games[self.winner[games]==i]
+
+    def losses(self, i, postseason=False):
+        '''Games lost by Squad row i. Same semantics as Squad.get_losses.'''
+        games = self.games(i, postseason=postseason, played=False)
+        return games[self.loser[games]==i]
+
+    def opponents(self, i, played=True, postseason=False):
+        '''Squad rows of opponents of Squad row i, once per game. Same
+        semantics as Squad.opponents.'''
+        games = self.games(i, postseason=postseason, played=False)
+        if played:
+            games = games[(self.winner[games]==i) | (self.loser[games]==i)]
+        ops = self.matchups[games]
+        ops = np.where(ops[:, 0]==i, ops[:, 1], ops[:, 0])
+        return ops[ops>=0]
+
+    def record(self, postseason=False):
+        '''Wins and losses of every Squad, as two arrays aligned with
+        squad_ids.'''
+        mask = np.ones(len(self.game_ids), dtype=bool)
+        if not postseason:
+            mask = ~self.postseason
+        n = len(self.squad_ids)
+        w, l = self.winner[mask], self.loser[mask]
+        return (np.bincount(w[w>=0], minlength=n),
+                np.bincount(l[l>=0], minlength=n))
+
+    ## Box scores
+
+    def _build_box(self):
+        '''Sum statsheets by (Game, Squad). N/A values count as 0.'''
+        if not self.has_statsheets:
+            raise ValueError("SeasonFrame was loaded without statsheets")
+
+        squads = self.member_squad[self.sheet_member]
+        keys = self.sheet_game * len(self.squad_ids) + squads
+        keys, inverse = np.unique(keys, return_inverse=True)
+
+        totals = np.zeros((len(keys), len(self.stats)))
+        np.add.at(totals, inverse, np.nan_to_num(self.sheet_stats))
+
+        self._box_keys = keys
+        self._box_game = keys // len(self.squad_ids)
+        self._box_squad = keys % len(self.squad_ids)
+        self._box = totals
+
+    def box_scores(self, i):
+        '''Box score totals of Squad row i. Returns (game rows, totals), the
+        latter with one row per game and one column per stat in
+        SeasonFrame.stats.'''
+        if self._box is None:
+            self._build_box()
+        mask = self._box_squad==i
+        return self._box_game[mask], self._box[mask]
+
+    def box(self, i, g):
+        '''Box score totals of Squad row i in Game row g. Returns a vector
+        with one entry per stat in SeasonFrame.stats, or None if there are no
+        statsheets for the Squad in that Game.'''
+        if self._box is None:
+            self._build_box()
+        key = g * len(self.squad_ids) + i
+        j = np.searchsorted(self._box_keys, key)
+        if j < len(self._box_keys) and self._box_keys[j]==key:
+            return self._box[j]
+        return None
+
+    def __repr__(self):
+        return "<SeasonFrame('%s', %d squads, %d games)>" \
+                % (self.season, len(self.squad_ids), len(self.game_ids))
+
+
+
+
+# -- HELPER FUNCTIONS -- //
+def _ints(values):
+    '''Integer array from a list that may contain Nones (stored as -1)'''
+    return np.array([-1 if v is None else v for v in values], dtype=int)
+
+
+def _floats(values):
+    '''Float array from a list that may contain Nones (stored as NaN)'''
+    return np.array([np.nan if v is None else v for v in values], dtype=float)
+
+
+def or_missing(v, missing=-1):
+    '''v, or missing (-1 by default, as in int arrays) if v is None'''
+    return missing if v is None else v
+
+
+def to_int(v):
+    '''Python int from an array value, None for -1'''
+    return None if v<0 else int(v)
+
+
+def to_float(v):
+    '''Python float from an array value, None for NaN'''
+    return None if np.isnan(v) else float(v)
+
+
+def _rows(ids, lookup):
+    '''Positions of `lookup` IDs in sorted array `ids`, -1 if not found.'''
+    if not len(ids):
+        return -np.ones(len(lookup), dtype=int)
+    pos = np.searchsorted(ids, lookup)
+    pos[pos>=len(ids)] = 0
+    return np.where((lookup>=0) & (ids[pos]==lookup), pos, -1)
@@ -68,7 +68,10 @@ Freely distributable under the MIT License.
 
 # Third Party Modules
 from sqlalchemy import *
-from sqlalchemy.orm import relationship, backref, sessionmaker, reconstructor
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import relationship, backref, sessionmaker, reconstructor,\
+                           synonym, object_session, Session
 from sqlalchemy.ext.declarative import declarative_base
 # Standard Library
 import re
@@ -76,26 +79,39 @@ import os
 import json
 import datetime
 import operator
+import hashlib
+import math
+import warnings
 from collections import OrderedDict, defaultdict
-from random import randint, seed
+from weakref import ref as _weakref
+from random import randint, seed, sample as _sample
 seed(datetime.datetime.now())
 
 
 # Try to load fuzzy text matching libraries, in order of (my) preference
 fuzzymatch = None
+# Matchers that score 2M/(|a|+|b|), like difflib's ratio. TeamIndex can only
+# shortlist candidates by trigrams for these (see TeamIndex.candidates).
+_ratio_matchers = set()
+# Jaro-Winkler matchers, which TeamIndex shortlists by the characters they
+# share (see TeamIndex.jaro_candidates).
+_jaro_matchers = set()
 # Written in C. Standard Levenstein algorithm
 try:
     from Levenstein import ratio as fuzzymatch
+    _ratio_matchers.add(fuzzymatch)
 except ImportError:
     # Written in Python. Levenstein is available in this package, but try
     # jaro_winkler, which I've had better luck with.
     try:
         from jellyfish import jaro_winkler as fuzzymatch
+        _jaro_matchers.add(fuzzymatch)
     except ImportError:
         # Default to stdlib difflib, which isn't a really good approach,
         # but it'll do in a pinch.
         from difflib import SequenceMatcher
         fuzzymatch = lambda a,b: SequenceMatcher(None, a,b).ratio()
+        _ratio_matchers.add(fuzzymatch)
 
 # Optional 3rd-party libraries
 try:
@@ -120,6 +136,142 @@ Base = declarative_base()
 
 
 
+# - Memo -- /
+class QueryMemo(object):
+    '''Bounded memo for derived Squad queries (get_games, get_wins,
+    get_losses, opponents, win_pct), one per Session. Get it with
+    QueryMemo.get(session).
+
+    The memo is cleared whenever a flush writes a Game or changes a Squad's
+    schedule, wins or losses, and on rollback, so results stay consistent
+    with the ORM in long-lived sessions. Changes made behind the ORM's back
+    (e.g., inserting into the schedule table with a Core statement) are not
+    seen; call clear() after those.
+
+    When the memo is full, the least recently used entries are evicted
+    first. Values are kept on the Squads they belong to, and the memo only
+    has weak references to those, so it doesn't keep Squads (or the Games
+    in their values) alive after the Session's weak identity map has let go
+    of them.'''
+
+    maxsize = 20000
+
+    def __init__(self, maxsize=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        # (squad id, key) -> weak reference to the Squad holding the value,
+        # least recently used first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def get(cls, session):
+        '''Get the memo attached to session, creating it if necessary.'''
+        # Sessions in SQLAlchemy 0.8 have no info dict, so the memo is kept
+        # as an attribute on the Session itself.
+        try:
+            return session._query_memo
+        except AttributeError:
+            memo = session._query_memo = cls()
+            return memo
+
+    def lookup(self, squad, key, compute):
+        '''Return memoized value of compute() for (squad, key). Values are
+        stored on the Squad instance, so a Squad reloaded after expunge
+        never sees stale objects.'''
+        sid = squad.id
+        if sid is None:
+            # Not persistent yet
+            return compute()
+
+        key = (sid,) + key
+        values = squad.__dict__.get('_memo_values')
+        if values is not None and key in values and key in self._entries:
+            self.hits += 1
+            # OrderedDict has no move_to_end in Python 2
+            self._entries[key] = self._entries.pop(key)
+            return values[key]
+
+        self.misses += 1
+        value = compute()
+        self._discard(key)
+        if values is None:
+            values = squad._memo_values = dict()
+        values[key] = value
+        self._entries[key] = _weakref(squad)
+        if len(self._entries) > self.maxsize:
+            self._discard(next(iter(self._entries)))
+        return value
+
+    def _discard(self, key):
+        '''Drop the entry for key, and its value from the Squad holding it
+        if that is still around.'''
+        ref = self._entries.pop(key, None)
+        squad = ref() if ref is not None else None
+        if squad is not None:
+            squad.__dict__.get('_memo_values', {}).pop(key, None)
+
+    def clear(self):
+        for ref in self._entries.itervalues():
+            squad = ref()
+            if squad is not None:
+                squad.__dict__.pop('_memo_values', None)
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "<QueryMemo(%d entries, %d hits, %d misses)>" \
+                % (len(self), self.hits, self.misses)
+
+
+def _schedule_changed(session):
+    '''True if objects being flushed can change the result of a memoized
+    Squad query.'''
+    for obj in session.new | session.deleted:
+        if isinstance(obj, (Game, Squad)):
+            return True
+    for obj in session.dirty:
+        if isinstance(obj, Game):
+            return True
+        if isinstance(obj, Squad):
+            attrs = inspect(obj).attrs
+            for key in ('schedule', 'wins', 'losses'):
+                if attrs[key].history.has_changes():
+                    return True
+    return False
+
+
+def _rosters_changed(session):
+    '''True if objects being flushed add or remove SquadMembers.'''
+    for obj in session.new | session.deleted:
+        if isinstance(obj, SquadMember):
+            return True
+    return False
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_memo_on_flush(session, flush_context):
+    memo = getattr(session, '_query_memo', None)
+    changed = _schedule_changed(session)
+    if memo is not None and len(memo) and changed:
+        memo.clear()
+    if changed or _rosters_changed(session):
+        # The completegame index is rebuilt the next time it's used
+        session._complete_games_stale = True
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _invalidate_memo_on_rollback(session, previous_transaction):
+    memo = getattr(session, '_query_memo', None)
+    if memo is not None:
+        memo.clear()
+
+
+
+
 # - Schedule -- /
 '''Schedule is the cross-reference table for establishing the many-to-many
 map from Squads to Games.'''
@@ -128,6 +280,10 @@ schedule = Table('schedule', Base.metadata,
     Column('squad_id', Integer, ForeignKey('squad.id', onupdate='cascade')),
     Column('type', Enum('home', 'away'))
 )
+# A Squad is in a Game at most once. This index also serves lookups by Game.
+Index('ix_schedule_game_squad', schedule.c.game_id, schedule.c.squad_id,
+      unique=True)
+Index('ix_schedule_squad_id', schedule.c.squad_id)
 
 
 
@@ -147,19 +303,21 @@ class Game(Base):
 
     id = Column(Integer, primary_key=True)
 
-    date = Column(Date)
+    date = Column(Date, index=True)
 
     # Map squads playing via schedule cross-reference Table
     opponents = relationship('Squad',
                              secondary=schedule,
                              backref=backref('schedule', order_by=date))
 
-    winner_id = Column(Integer, ForeignKey('squad.id', onupdate='cascade'))
+    winner_id = Column(Integer, ForeignKey('squad.id', onupdate='cascade'),
+                       index=True)
     winner = relationship('Squad', foreign_keys=[winner_id],
                           backref=backref('wins', order_by=date))
     winner_score = Column(Integer)
 
-    loser_id = Column(Integer, ForeignKey('squad.id', onupdate='cascade'))
+    loser_id = Column(Integer, ForeignKey('squad.id', onupdate='cascade'),
+                      index=True)
     loser = relationship('Squad', foreign_keys=[loser_id],
                          backref=backref('losses', order_by=date))
     loser_score = Column(Integer)
@@ -212,10 +370,69 @@ class Game(Base):
                     self.winner = home_team
 
     @staticmethod
-    def get_games_with_data(session, limit=None, random=True):
+    def get_games_with_data(session, limit=None, random=True, chunksize=None):
         '''Query the database only for Games that have stats for both
         teams. Optionally specify whether random sample should be obtained
-        (by default, yes) and how many Games to return (by default, all).'''
+        (by default, yes) and how many Games to return (by default, all).
+
+        Games are drawn from the completegame table, which dbmgr rebuilds
+        after ingest (or call Game.index_complete_games yourself). A
+        warning is given if it looks out of date, i.e. this Session has
+        flushed Games, schedules or SquadMembers since it was built, or the
+        highest game and squadmember IDs have changed (rows added by another
+        process). Databases ingested before the table existed haven't been
+        indexed yet; then a warning is given and it is built here, in the
+        Session's transaction (commit to keep it). If it can't be (no table,
+        or a read-only database), Games are queried the slow way, by sorting
+        all of them. A random sample picks row numbers in Python, so it
+        costs O(limit) instead of sorting every Game in the database.
+
+        By default a list is returned. Give chunksize to get an iterator
+        instead, which loads chunksize Games at a time.'''
+        recorded = Game._complete_games_fingerprint(session)
+        if recorded is None:
+            warnings.warn("Games with complete data haven't been indexed "
+                          "yet; indexing them now", stacklevel=2)
+            try:
+                Game.index_complete_games(session)
+            except OperationalError:
+                games = Game._query_games_with_data(session, limit, random)
+                if chunksize is not None:
+                    return iter(games)
+                return games
+            recorded = Game._complete_games_fingerprint(session)
+
+        if getattr(session, '_complete_games_stale', False) \
+                or recorded!=_complete_games_source(session):
+            warnings.warn("Index of games with complete data is out of "
+                          "date; call Game.index_complete_games to rebuild it",
+                          stacklevel=2)
+
+        lo, n = session.execute(select([func.min(completegame.c.id),
+                                        func.count(completegame.c.id)]))\
+                       .first()
+        lo = lo or 0
+
+        k = n if limit is None else min(limit, n)
+
+        # Row numbers in completegame are dense, so a sample of them is a
+        # sample of complete Games
+        if random:
+            rows = _sample(xrange(lo, lo+n), k)
+        else:
+            rows = xrange(lo, lo+k)
+
+        games = Game._iter_complete_games(session, rows, chunksize or 500)
+
+        if chunksize is not None:
+            return games
+        return list(games)
+
+    @staticmethod
+    def _query_games_with_data(session, limit, random):
+        '''Games with stats for both teams, found without the completegame
+        table. Sorts every Game, so only used when the table can't be
+        built.'''
         q_incomplete = session.query(Game)\
                               .join(Game.opponents)\
                               .filter(Game.opponents.any(Squad.roster==None))
@@ -234,6 +451,78 @@ class Game(Base):
 
         return q2.all()
 
+    @staticmethod
+    def _iter_complete_games(session, rows, chunksize):
+        '''Yield Games at given completegame row numbers, in order. Games
+        are loaded chunksize at a time.'''
+        rows = list(rows)
+        for i in xrange(0, len(rows), chunksize):
+            chunk = rows[i:i+chunksize]
+            found = dict(session.query(completegame.c.id, Game)\
+                                .join(Game, Game.id==completegame.c.game_id)\
+                                .filter(completegame.c.id.in_(chunk))\
+                                .all())
+            for row in chunk:
+                if row in found:
+                    yield found[row]
+
+    @staticmethod
+    def index_complete_games(session):
+        '''Rebuild the completegame table, which lists the Games that have
+        data for training: regular season Games with a winner, where both
+        Squads have a roster. Games are numbered densely, by ID.
+
+        Call this after ingesting games, rosters or scores (dbmgr does).
+        The tables are created with the rest of the schema, by dbmgr.
+        Returns the number of complete Games.'''
+        session.flush()
+
+        game = Game.__table__
+        member = SquadMember.__table__
+
+        # Games with a Squad that has no roster
+        incomplete = select([schedule.c.game_id])\
+                        .select_from(schedule.outerjoin(member,
+                                    member.c.squad_id==schedule.c.squad_id))\
+                        .where(member.c.id==None)
+
+        complete = select([game.c.id])\
+                        .where(game.c.winner_id!=None)\
+                        .where(or_(game.c.postseason==None,
+                                   game.c.postseason==False))\
+                        .where(~game.c.id.in_(incomplete))\
+                        .order_by(game.c.id)
+
+        session.execute(completegame.delete())
+        session.execute(completegame.insert()\
+                                    .from_select(['game_id'], complete))
+
+        session.execute(completegamestate.delete())
+        session.execute(completegamestate.insert()\
+                            .values(fingerprint=_complete_games_source(session)))
+        session._complete_games_stale = False
+
+        return session.execute(select([func.count(completegame.c.id)]))\
+                      .scalar()
+
+    @staticmethod
+    def _complete_games_fingerprint(session):
+        '''Fingerprint recorded when completegame was last built, or None
+        if it never was (or the tables don't exist yet).'''
+        try:
+            return session.execute(select([completegamestate.c.fingerprint]))\
+                          .scalar()
+        except OperationalError:
+            return None
+
+    def update_derived_stats(self):
+        '''Count this Game in the cached games played of its opponents. Call
+        once, when the Game is created. Caches that haven't been derived yet
+        are left alone.'''
+        for squad in self.opponents:
+            if squad._stats is not None:
+                squad._stats.add({}, games_played=1.)
+
     def __contains__(self, squad):
         return squad in game.opponents
 
@@ -246,6 +535,24 @@ class Game(Base):
 
 
 
+# - Complete Games -- /
+'''Dense index of the Games that have complete data, for fast random
+sampling. Maintained by Game.index_complete_games.'''
+completegame = Table('completegame', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('game_id', Integer, ForeignKey('game.id', onupdate='cascade'))
+)
+
+'''Fingerprint of the tables completegame was built from, to tell when it
+is out of date (see _complete_games_source). One row, once built.'''
+completegamestate = Table('completegamestate', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('fingerprint', String)
+)
+
+
+
+
 # - Player -- /
 class Player(Base):
     '''Players hold vital statistics like height, number, position, etc.
@@ -293,6 +600,12 @@ class SquadMember(Base):
     '''This is the class that holds individual game statistics for a Player.
     Many-to-one maps to Player, Squad, and Game'''
     __tablename__ = 'squadmember'
+    __table_args__ = (
+        # A Player is on a Squad at most once
+        Index('ix_squadmember_player_squad', 'player_id', 'squad_id',
+              unique=True),
+        Index('ix_squadmember_squad_id', 'squad_id'),
+    )
 
     id = Column(Integer, primary_key=True)
 
@@ -303,9 +616,20 @@ class SquadMember(Base):
     squad = relationship('Squad', backref=backref('roster', order_by=id))
 
     stats_id = Column(Integer, ForeignKey('statscache.id', onupdate='cascade'))
-    stats = relationship('SquadMemberDerivedStats', backref=backref('referent',
-                                                               uselist=False,
-                                                               order_by=id))
+    _stats = relationship('SquadMemberDerivedStats', backref=backref('referent',
+                                                                uselist=False,
+                                                                order_by=id))
+
+    def _get_stats(self):
+        # Derived stats are computed on first access, not on load.
+        if self._stats is None:
+            self.derive_stats()
+        return self._stats
+
+    def _set_stats(self, stats):
+        self._stats = stats
+
+    stats = synonym('_stats', descriptor=property(_get_stats, _set_stats))
 
     # NOTE statsheets = one-to-many mapping to PlayerStatSheets
 
@@ -322,11 +646,6 @@ class SquadMember(Base):
         if year is not None:
             self.year = year
 
-    @reconstructor
-    def _reconstruct(self):
-        if self.stats is None:
-            self.derive_stats()
-
     def derive_stats(self):
         '''Calculate and cache derived statistics'''
         derived_stats = defaultdict(float)
@@ -360,13 +679,13 @@ class SquadMember(Base):
                 derived_stats[newfield] = derived_stats[num] / den
 
         # Store the derived stats
-        if self.stats is not None:
+        if self._stats is not None:
             # Update old entry
             for stat, val in derived_stats.items():
-                self.stats[stat] = val
+                self._stats[stat] = val
         else:
             # Create new entry
-            self.stats = SquadMemberDerivedStats(derived_stats)
+            self._stats = SquadMemberDerivedStats(derived_stats)
 
     def __repr__(self):
         return "<SquadMember('%s %s', '%s', '%s')>" % \
@@ -380,6 +699,12 @@ class SquadMember(Base):
 class PlayerStatSheet(Base):
     '''Contains the stats of one SquadMember in one Game'''
     __tablename__ = 'playerstatsheet'
+    __table_args__ = (
+        # One statsheet per SquadMember per Game
+        Index('ix_playerstatsheet_game_squadmember', 'game_id',
+              'squadmember_id', unique=True),
+        Index('ix_playerstatsheet_squadmember_id', 'squadmember_id'),
+    )
 
     id = Column(Integer, primary_key=True)
 
@@ -428,6 +753,25 @@ class PlayerStatSheet(Base):
         'fouls',
     ]
 
+    def update_derived_stats(self):
+        '''Add this statsheet to the cached derived stats of its SquadMember
+        and of their Squad. Call once, after the stats have been filled in.
+        Caches that haven't been derived yet are left alone, since they will
+        include this statsheet when they are.'''
+        if not self.minutes_played:
+            # Played 0 minutes, doesn't count (same as in derive_stats)
+            return
+
+        vals = dict((stat, getattr(self, stat)) for stat in self.stats)
+
+        member = self.squadmember
+        if member._stats is not None:
+            member._stats.add(vals, games_played=1.)
+
+        squad = member.squad
+        if squad is not None and squad._stats is not None:
+            squad._stats.add(vals)
+
     def __repr__(self):
         name = "%s %s" % (self.squadmember.player.first_name,
                           self.squadmember.player.last_name)
@@ -449,7 +793,7 @@ class DerivedStats(Base):
 
     # One-to-One relationship with Squad / SquadMember
 
-    # Derived statistics -- all calculated on load, stored in self.stats
+    # Derived statistics -- calculated on first access, stored in self.stats
     sumfields = [
         # Sums
         'minutes_played',
@@ -548,6 +892,197 @@ class DerivedStats(Base):
         keys = self.sumfields + self.pctfields.keys()
         return [(key, getattr(self, key)) for key in keys]
 
+    def add(self, stats, games_played=0.):
+        '''Add the sums in dict `stats` (and games_played) to these derived
+        stats, then recompute the percentages and averages. Keeps the cache
+        up to date as new statsheets come in without a full derive_stats().'''
+        sums = dict((f, self[f] or 0.)
+                        for f in ['games_played'] + self.sumfields)
+        sums['games_played'] += games_played
+        for f in self.sumfields:
+            sums[f] += stats.get(f) or 0.
+        for f, val in DerivedStats.compute_ratios(sums).items():
+            self[f] = val
+
+    @staticmethod
+    def compute_ratios(stats):
+        '''Fill in percentages and averages in dict `stats` from the sums
+        already in it. A 0 denominator gives 0, as in derive_stats.'''
+        for newfield, (num, den) in DerivedStats.pctfields.items():
+            den = stats.get(den) or 0.
+            if den == 0.:
+                stats[newfield] = 0.
+            else:
+                stats[newfield] = (stats.get(num) or 0.) / den
+        return stats
+
+    @staticmethod
+    def rebuild(session, season=None, batch_size=1000, missing_only=False):
+        '''Recompute the statscache rows of every SquadMember and Squad (in
+        the given season, or in the whole DB by default) in bulk. This gives
+        the same values as calling derive_stats() on each Squad, but the sums
+        are done by the DB with GROUP BY instead of by looping over every
+        PlayerStatSheet in Python. Existing statscache rows are updated and
+        missing ones are inserted, batch_size rows at a time. Set
+        missing_only to only fill in the missing ones.
+
+        Changes are flushed but not committed. Returns the number of
+        SquadMember and Squad rows written, as a tuple.'''
+        session.flush()
+
+        members = DerivedStats._member_sums(session, season, missing_only)
+        squads = DerivedStats._squad_sums(session, season, missing_only)
+
+        DerivedStats._upsert(session, SquadMember.__table__, 'squadmember',
+                             members, batch_size)
+        DerivedStats._upsert(session, Squad.__table__, 'squad',
+                             squads, batch_size)
+
+        # Objects already in the session now hold stale stats
+        for obj in session.identity_map.values():
+            if isinstance(obj, (DerivedStats, SquadMember, Squad)):
+                session.expire(obj)
+
+        return (len(members), len(squads),)
+
+    @staticmethod
+    def backfill(session, season=None, batch_size=1000):
+        '''Fill in statscache rows for SquadMembers and Squads that don't have
+        one yet. Derived stats are otherwise only computed when they are first
+        accessed; run this after loading new data so that reading them stays
+        cheap. Same arguments and return value as rebuild().'''
+        return DerivedStats.rebuild(session, season=season,
+                                    batch_size=batch_size, missing_only=True)
+
+    @staticmethod
+    def _sheet_sums(sheet):
+        '''Sum columns for statsheets, N/A values count as 0.'''
+        return [func.coalesce(func.sum(func.coalesce(getattr(sheet.c, f), 0)),
+                              0).label(f)
+                    for f in DerivedStats.sumfields]
+
+    @staticmethod
+    def _played(member, sheet):
+        '''Join condition for the statsheets of games a member played in.
+        Statsheets with no minutes played are skipped, as in derive_stats.'''
+        return and_(sheet.c.squadmember_id==member.c.id,
+                    sheet.c.minutes_played!=None,
+                    sheet.c.minutes_played!=0)
+
+    @staticmethod
+    def _member_sums(session, season, missing_only=False):
+        '''Rows of (id, stats_id, has_cache, stats dict) for SquadMembers.'''
+        member = SquadMember.__table__
+        sheet = PlayerStatSheet.__table__
+        squad = Squad.__table__
+        cache = DerivedStats.__table__
+
+        source = member.outerjoin(sheet, DerivedStats._played(member, sheet))\
+                       .outerjoin(cache, cache.c.id==member.c.stats_id)
+        if season is not None:
+            source = source.join(squad, squad.c.id==member.c.squad_id)
+
+        q = select([member.c.id, member.c.stats_id, cache.c.id,
+                    func.count(sheet.c.id).label('games_played')]
+                        + DerivedStats._sheet_sums(sheet))\
+              .select_from(source)\
+              .group_by(member.c.id, member.c.stats_id, cache.c.id)
+        if season is not None:
+            q = q.where(squad.c.season==season)
+        if missing_only:
+            q = q.where(cache.c.id==None)
+
+        fields = ['games_played'] + DerivedStats.sumfields
+        ret = []
+        for row in session.execute(q):
+            stats = dict((f, float(v)) for f, v in zip(fields, row[3:]))
+            ret.append((row[0], row[1], row[2] is not None,
+                        DerivedStats.compute_ratios(stats),))
+        return ret
+
+    @staticmethod
+    def _squad_sums(session, season, missing_only=False):
+        '''Rows of (id, stats_id, has_cache, stats dict) for Squads. Sums are
+        over the Squad's members; games played is the number of Games on its
+        schedule, as in Squad.derive_stats.'''
+        squad = Squad.__table__
+        member = SquadMember.__table__
+        sheet = PlayerStatSheet.__table__
+        cache = DerivedStats.__table__
+
+        q = select([squad.c.id, squad.c.stats_id, cache.c.id]
+                        + DerivedStats._sheet_sums(sheet))\
+              .select_from(squad.outerjoin(member,
+                                           member.c.squad_id==squad.c.id)\
+                                .outerjoin(sheet,
+                                           DerivedStats._played(member, sheet))\
+                                .outerjoin(cache,
+                                           cache.c.id==squad.c.stats_id))\
+              .group_by(squad.c.id, squad.c.stats_id, cache.c.id)
+
+        gq = select([schedule.c.squad_id, func.count()])\
+               .select_from(schedule.join(squad,
+                                          squad.c.id==schedule.c.squad_id))\
+               .group_by(schedule.c.squad_id)
+
+        if season is not None:
+            q = q.where(squad.c.season==season)
+            gq = gq.where(squad.c.season==season)
+        if missing_only:
+            q = q.where(cache.c.id==None)
+
+        games_played = dict(session.execute(gq).fetchall())
+
+        ret = []
+        for row in session.execute(q):
+            stats = dict((f, float(v)) for f, v
+                                        in zip(DerivedStats.sumfields, row[3:]))
+            stats['games_played'] = float(games_played.get(row[0], 0))
+            ret.append((row[0], row[1], row[2] is not None,
+                        DerivedStats.compute_ratios(stats),))
+        return ret
+
+    @staticmethod
+    def _upsert(session, owner, type_, rows, batch_size):
+        '''Write statscache rows for the `owner` table (squad or squadmember)
+        in batches. Rows that don't have a cache entry yet get a new one with
+        an explicit ID, which is then linked from the owner row.'''
+        cache = DerivedStats.__table__
+        fields = ['games_played'] + DerivedStats.sumfields \
+                    + DerivedStats.pctfields.keys()
+
+        update = cache.update()\
+                      .where(cache.c.id==bindparam('_id'))\
+                      .values(**dict((f, bindparam('_'+f)) for f in fields))
+        link = owner.update()\
+                    .where(owner.c.id==bindparam('_id'))\
+                    .values(stats_id=bindparam('_stats_id'))
+
+        next_id = (session.execute(select([func.max(cache.c.id)])).scalar()
+                        or 0) + 1
+
+        for i in range(0, len(rows), batch_size):
+            updates, inserts, links = [], [], []
+
+            for oid, stats_id, has_cache, stats in rows[i:i+batch_size]:
+                if has_cache:
+                    params = dict(('_'+f, stats[f]) for f in fields)
+                    params['_id'] = stats_id
+                    updates.append(params)
+                else:
+                    params = dict((f, stats[f]) for f in fields)
+                    params['id'] = next_id
+                    params['type'] = type_
+                    inserts.append(params)
+                    links.append(dict(_id=oid, _stats_id=next_id))
+                    next_id += 1
+
+            if updates:
+                session.execute(update, updates)
+            if inserts:
+                session.execute(cache.insert(), inserts)
+                session.execute(link, links)
+
     def __repr__(self):
         items = ["'%s': %f" % (k, v) for k, v in self.items()]
         return "<DerivedStats(%s)>" % ', '.join(items)
@@ -572,6 +1107,10 @@ class Squad(Base):
 
     One-to-many maps to SquadMembers, Games. Many-to-one map to Team.'''
     __tablename__ = 'squad'
+    __table_args__ = (
+        # A Team has one Squad per season
+        Index('ix_squad_team_season', 'team_id', 'season', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     season = Column(String, nullable=False)
@@ -580,9 +1119,20 @@ class Squad(Base):
     team = relationship("Team", backref=backref('squads', order_by=id))
 
     stats_id = Column(Integer, ForeignKey('statscache.id', onupdate='cascade'))
-    stats = relationship('SquadDerivedStats', backref=backref('referent',
-                                                              uselist=False,
-                                                              order_by=id))
+    _stats = relationship('SquadDerivedStats', backref=backref('referent',
+                                                               uselist=False,
+                                                               order_by=id))
+
+    def _get_stats(self):
+        # Derived stats are computed on first access, not on load.
+        if self._stats is None:
+            self.derive_stats()
+        return self._stats
+
+    def _set_stats(self, stats):
+        self._stats = stats
+
+    stats = synonym('_stats', descriptor=property(_get_stats, _set_stats))
 
     # NOTE roster = one-to-many map to SquadMembers
     # NOTE schedule = many-to-many map to Games
@@ -597,15 +1147,16 @@ class Squad(Base):
 
     def __init__(self, season, team=None):
         self.season = season
-        self._cache = dict()        # Cache is never persisted.
         if team is not None:
             self.team = team
 
-    @reconstructor
-    def _reconstruct(self):
-        self._cache = dict()        # Cache is never persisted.
-        if self.stats is None:
-            self.derive_stats()
+    def _memoized(self, key, compute, cache=True):
+        '''Get value of compute() through the Session's QueryMemo. Squads
+        that are not persistent yet are never memoized.'''
+        session = object_session(self)
+        if not cache or session is None:
+            return compute()
+        return QueryMemo.get(session).lookup(self, key, compute)
 
     def derive_stats(self):
         '''Derive statistics'''
@@ -634,17 +1185,23 @@ class Squad(Base):
             derived_stats[newfield] = derived_stats[num] / den
 
         # Store derived stats in cache
-        if self.stats is not None:
+        if self._stats is not None:
             # Update existing record
             for stat, val in derived_stats.items():
-                self.stats[stat] = val
+                self._stats[stat] = val
         else:
             # Create new record
-            self.stats = SquadDerivedStats(derived_stats)
+            self._stats = SquadDerivedStats(derived_stats)
 
-    def win_pct(self, weighted=False, postseason=False):
+    def win_pct(self, weighted=False, postseason=False, cache=True):
         '''Calculate win percentage. Weighted win pct multiplies home wins
-        by .6, home losses by 1.4, away wins by 1.4 and away losses by .6.'''
+        by .6, home losses by 1.4, away wins by 1.4 and away losses by .6.
+        Result is memoized in the Session's QueryMemo unless cache=False.'''
+        return self._memoized(('win_pct', weighted, postseason),
+                              lambda: self._win_pct(weighted, postseason),
+                              cache)
+
+    def _win_pct(self, weighted, postseason):
         w = float(len(self.wins))
         l = float(len(self.losses))
 
@@ -704,11 +1261,13 @@ class Squad(Base):
 
     def opponents(self, played=True, postseason=False, cache=True):
         '''Get opponents. If played is True, only get opponents in games that
-        have been played so far. By default exclude postseason games.'''
-        _cachekey = 'opponents%s%s' % (played, postseason)
-        if cache and self._cache.has_key(_cachekey):
-            return self._cache[_cachekey]
+        have been played so far. By default exclude postseason games.
+        Result is memoized in the Session's QueryMemo unless cache=False.'''
+        return self._memoized(('opponents', played, postseason),
+                              lambda: self._opponents(played, postseason),
+                              cache)
 
+    def _opponents(self, played, postseason):
         sched = self.schedule
         if played:
             sched = self.wins + self.losses
@@ -716,14 +1275,9 @@ class Squad(Base):
         if not postseason:
             sched = [gm for gm in sched if not gm.postseason]
 
-        ret = [op for op in sum([gm.opponents for gm in sched], [])
+        return [op for op in sum([gm.opponents for gm in sched], [])
                 if op is not self]
 
-        if cache:
-            self._cache[_cachekey] = ret
-
-        return ret
-
     def _owp(self):
         '''Opponents winning percentage'''
         w = sum([len(op.get_wins()) for op in self.opponents()], 0.)
@@ -745,67 +1299,52 @@ class Squad(Base):
 
     def get_games(self, postseason=False, played=True, cache=True):
         '''Get games, optionally including postseason games. Set cache=True
-        to read from / write to transient instance cache instead of
-        recalculating this value each time it is needed. Cache is sensitive
+        to read from / write to the Session's QueryMemo instead of
+        recalculating this value each time it is needed. Memo is sensitive
         to the parameters you pass.'''
-        _cachekey = 'games%s%s' % (postseason, played)
-        if cache and self._cache.has_key(_cachekey):
-            return self._cache[_cachekey]
+        return self._memoized(('games', postseason, played),
+                              lambda: self._get_games(postseason, played),
+                              cache)
 
+    def _get_games(self, postseason, played):
         games = []
         if postseason:
-            games = self.schedule
+            games = list(self.schedule)
         else:
             games = [g for g in self.schedule if not g.postseason]
 
         if played:
             games = [g for g in games if g.winner is not None]
 
-        if cache:
-            self._cache[_cachekey] = games
-
         return games
 
     def get_wins(self, postseason=False, cache=True):
         '''Get wins, optionally including postseason. Set cache=True to read
-        from / write to transient instance cache instead of recalculating
+        from / write to the Session's QueryMemo instead of recalculating
         value each time it is needed.'''
-        _cachekey = 'wins%s' % postseason
-        if cache and self._cache.has_key(_cachekey):
-            return self._cache[_cachekey]
+        return self._memoized(('wins', postseason),
+                              lambda: self._get_wins(postseason), cache)
 
-        wins = []
+    def _get_wins(self, postseason):
         if postseason:
-            wins = self.wins
-        else:
-            wins = [g for g in self.wins if not g.postseason]
-
-        if cache:
-            self._cache[_cachekey] = wins
-
-        return wins
+            return list(self.wins)
+        return [g for g in self.wins if not g.postseason]
 
     def get_losses(self, postseason=False, cache=True):
         '''Get losses, optionally including postseason. Set cache=True to
-        read from / write to transient instance cache instead of recalculating
+        read from / write to the Session's QueryMemo instead of recalculating
         value each time it is needed.'''
-        _cachekey = 'losses%s' % postseason
-        if cache and self._cache.has_key(_cachekey):
-            return self._cache[_cachekey]
+        return self._memoized(('losses', postseason),
+                              lambda: self._get_losses(postseason), cache)
 
-        losses = []
+    def _get_losses(self, postseason):
         if postseason:
-            losses = self.losses
-        else:
-            losses = [g for g in self.losses if not g.postseason]
-
-        if cache:
-            self._cache[_cachekey] = losses
-
-        return losses
+            return list(self.losses)
+        return [g for g in self.losses if not g.postseason]
 
     def get_rpi(self):
-        '''Calculate RPI.'''
+        '''Calculate RPI. To rate a whole season at once, use
+        ncaalib.ratings.RPIRater instead, which is much faster.'''
         wp = self.win_pct(weighted=True)
         opponents = self.opponents()
         owp = self._owp()
@@ -821,6 +1360,9 @@ class Squad(Base):
         '''Get Squad in Season in DB (session) using a more forigiving
         search (through TeamAliases)'''
         tid = Team.get(session, name).id
+        squad = TeamIndex.get(session).squad(tid, season)
+        if squad is not None:
+            return squad
         return session.query(Squad).filter(Squad.team_id==tid,
                                            Squad.season==season).one()
 
@@ -856,7 +1398,11 @@ class Team(Base):
 
     @staticmethod
     def get(session, name):
-        '''Convenience function for getting teams by name.'''
+        '''Convenience function for getting teams by name. Raises
+        NoResultFound if there is no such team.'''
+        team = TeamIndex.get(session).team(name)
+        if team is not None:
+            return team
         normalized_name = normalize_name(name)
         ta = session.query(TeamAlias).filter_by(name=normalized_name).one()
         return ta.team
@@ -870,39 +1416,21 @@ class Team(Base):
         interfaces with the first one it finds. Last choice is standard library
         difflib, which isn't great for this task but it'll work in a pinch.
 
-        Returns OrderedDict of IDs of Teams hwose name (any variation of it)
-        matches the provided `name` above a certain threshold. Keys are IDs,
-        values are match percentile.'''
-        normalized_name = normalize_name(name)
-
-        match_func = lambda s: method(normalized_name, s)
+        Returns list of (Team, match percentile) for Teams whose name (any
+        variation of it) matches the provided `name` above a certain
+        threshold, sorted by match percentile. Candidate aliases are
+        shortlisted for the matchers this module loads, and every alias is
+        scored for any other matcher (see TeamIndex.search).'''
+        return Team.search_many(session, [name], threshold, method)[0]
 
-        # Create a function for the SQL to use
-        c = session.bind.connect()
-        c.connection.create_function('distance', 1, match_func)
-
-        # Execute query
-        query = "SELECT `team_id`, distance(name) \
-                 FROM `teamalias` \
-                 WHERE distance(name)>=:threshold"
-        res = c.execute(query, dict(threshold=threshold))
-
-        if res is None:
-            return None
-
-        unique_results = OrderedDict()
-        for row in res:
-            # Compact results into ordered dict by referenced Team name and
-            # store highest score
-            if unique_results.has_key(row[0]) and \
-            unique_results[row[0]]>row[1]:
-                # Stored match is higher
-                continue
-            unique_results[row[0]] = row[1]
-
-        # Sort results and return
-        s = OrderedDict(sorted(unique_results.items(), key=lambda d: d[1]))
-        return [(session.query(Team).get(k), v) for k,v in s.items()]
+    @staticmethod
+    def search_many(session, names, threshold=.9, method=fuzzymatch):
+        '''Team.search for each name in names. Returns a list of results,
+        one per name.'''
+        index = TeamIndex.get(session)
+        return [[(index.team_by_id(k), v) for k, v in matches.items()]
+                    for matches in index.search_many(names, threshold,
+                                                     method)]
 
     def __repr__(self):
         return "<Team('%s')>" % self.name
@@ -924,7 +1452,7 @@ class TeamAlias(Base):
     __tablename__ = 'teamalias'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
+    name = Column(String, nullable=False, unique=True, index=True)
 
     team_id = Column(Integer, ForeignKey('team.id', onupdate='cascade'))
     team = relationship("Team", backref=backref('aliases', order_by=id))
@@ -938,6 +1466,293 @@ class TeamAlias(Base):
 
 
 
+# - TeamIndex -- /
+class TeamIndex(object):
+    '''In-memory index for resolving Teams and Squads, one per Session. Get
+    it with TeamIndex.get(session).
+
+    Maps normalized alias names and exact Team names to Team IDs, and
+    (Team ID, season) to Squad IDs. Everything is loaded in three queries the
+    first time the index is used, then kept in sync as TeamAliases, Teams and
+    Squads are flushed. Lookups that miss fall back to the database, so
+    objects that haven't been flushed yet are still found.
+
+    Teams and Squads that have been looked up are referenced by the index,
+    so they stay in the Session's (weak) identity map and aren't loaded
+    again on the next lookup.'''
+
+    def __init__(self, session):
+        self._session = session
+        self._objects = dict()
+        self._grams = None
+
+        self.aliases = dict(session.query(TeamAlias.name, TeamAlias.team_id))
+
+        # Team names aren't unique. Ambiguous names map to None.
+        self.names = dict()
+        for tid, name in session.query(Team.id, Team.name):
+            self._add_name(name, tid)
+
+        self.squads = dict(((tid, season), sid) for sid, tid, season
+                in session.query(Squad.id, Squad.team_id, Squad.season))
+
+    @classmethod
+    def get(cls, session):
+        '''Get the index attached to session, loading it if necessary.'''
+        try:
+            return session._team_index
+        except AttributeError:
+            index = session._team_index = cls(session)
+            return index
+
+    def _add_name(self, name, tid):
+        if self.names.get(name, tid)!=tid:
+            self.names[name] = None
+        else:
+            self.names[name] = tid
+
+    def team_id(self, name):
+        '''ID of Team with alias `name` (normalized here), or None.'''
+        normalized_name = normalize_name(name)
+        tid = self.aliases.get(normalized_name)
+        if tid is None:
+            ta = self._session.query(TeamAlias)\
+                              .filter_by(name=normalized_name).first()
+            if ta is None:
+                return None
+            tid = ta.team_id
+            self._add_alias(normalized_name, tid)
+        return tid
+
+    def _add_alias(self, name, tid):
+        self.aliases[name] = tid
+        if self._grams is not None:
+            self._index_alias(name)
+
+    ## Fuzzy matching
+
+    def _fuzzy_index(self):
+        '''Build the trigram, character and length indexes of the aliases,
+        on first use.'''
+        if self._grams is None:
+            self._grams = defaultdict(set)
+            self._chars = defaultdict(lambda: defaultdict(set))
+            self._lengths = defaultdict(set)
+            for alias in self.aliases:
+                self._index_alias(alias)
+
+    def _index_alias(self, name):
+        for gram in _trigrams(name):
+            self._grams[gram].add(name)
+        for key in _char_keys(name):
+            self._chars[len(name)][key].add(name)
+        self._lengths[len(name)].add(name)
+
+    def candidates(self, name, threshold=0.):
+        '''Aliases that can match normalized `name` with a similarity ratio
+        of at least threshold, judging by the trigrams they share with it.
+        The trigram index is built on first use.
+
+        A ratio 2M/(|a|+|b|) of at least t (as computed by difflib or
+        Levenshtein.ratio) leaves at most k = (1-t)(|a|+|b|) characters
+        unmatched, and each one breaks at most three of the distinct
+        trigrams of `name` (|a|+1 at most, fewer if some repeat, as in
+        "MISSISSIPPI"). Aliases sharing fewer trigrams than that are
+        dropped. For low thresholds long aliases can pass without sharing
+        any, so those are added by length.'''
+        self._fuzzy_index()
+
+        grams = self._grams
+        query = _trigrams(name)
+        shared = defaultdict(int)
+        for gram in query:
+            for alias in grams.get(gram, ()):
+                shared[alias] += 1
+
+        n, m = len(name), len(query)
+        slack = 3. * (1.-threshold)
+        ret = [alias for alias, count in shared.iteritems()
+                    if count >= m - slack*(n+len(alias))]
+
+        if slack > 0:
+            # Aliases at least this long need no shared trigram
+            cutoff = m/slack - n
+            for length, aliases in self._lengths.iteritems():
+                if length >= cutoff:
+                    ret.extend(a for a in aliases if a not in shared)
+        return ret
+
+    def jaro_candidates(self, name, threshold=0.):
+        '''Aliases that can match normalized `name` with a Jaro-Winkler
+        similarity of at least threshold, judging by their length and the
+        characters they share with it. The index is built on first use.
+
+        Winkler's prefix bonus adds at most .4(1-J) to the Jaro similarity
+        J, so J is at least j = (t-.4)/.6. With m matching characters,
+        J <= (m/|a| + m/|b| + 1)/3, so m/|a| + m/|b| >= r = 3j-1, and m is
+        at most the number of characters the names have in common. That
+        bounds |b|, and for each |b| the characters an alias must share; an
+        alias sharing k of the n characters of `name` shares one of any
+        n-k+1 of them, so only aliases with one of the rarest are looked
+        at. For t <= .8 the bound rules out too little to pay off, and every
+        alias is a candidate.'''
+        self._fuzzy_index()
+
+        keys = _char_keys(name)
+        n = len(keys)
+        r = 3. * (threshold-.4)/.6 - 1.
+        if r <= 1. + 1e-9 or n == 0:
+            # t <= .8: too weak a bound to beat scoring every alias
+            return list(self.aliases)
+
+        ret = []
+        for length, chars in self._chars.iteritems():
+            # m <= min(|a|, |b|)
+            if min(length, n) * (1./n + 1./length) < r - 1e-9:
+                continue
+            fewest = int(math.ceil(r*n*length/(n+length) - 1e-9))
+            rare = sorted(keys, key=lambda k: len(chars.get(k, ())))
+            found = set()
+            for key in rare[:n-fewest+1]:
+                found.update(chars.get(key, ()))
+            ret.extend(found)
+        return ret
+
+    def search(self, name, threshold=.9, matcher=fuzzymatch):
+        '''Fuzzy match `name` against all aliases. Only candidates are scored:
+        the ones that pass the trigram filter (see TeamIndex.candidates) if
+        matcher is ratio-based (difflib, or Levenshtein.ratio), the ones
+        that pass the character filter (see TeamIndex.jaro_candidates) if it
+        is jellyfish's jaro_winkler. Every alias is scored with any other
+        matcher, since neither filter is known to hold for it.
+
+        Returns OrderedDict mapping Team IDs to their best score, for scores
+        of at least threshold, in increasing order of score.'''
+        normalized_name = normalize_name(name)
+
+        if matcher in _ratio_matchers:
+            aliases = self.candidates(normalized_name, threshold)
+        elif matcher in _jaro_matchers:
+            aliases = self.jaro_candidates(normalized_name, threshold)
+        else:
+            aliases = self.aliases
+
+        best = dict()
+        for alias in aliases:
+            score = matcher(normalized_name, alias)
+            if score < threshold:
+                continue
+            tid = self.aliases[alias]
+            if score > best.get(tid, -1):
+                best[tid] = score
+
+        return OrderedDict(sorted(best.items(), key=lambda d: d[1]))
+
+    def search_many(self, names, threshold=.9, matcher=fuzzymatch):
+        '''TeamIndex.search for many names at once. Names that normalize to
+        the same thing are only matched once. Returns list of results in the
+        same order as names.'''
+        results = dict()
+        ret = []
+        for name in names:
+            normalized_name = normalize_name(name)
+            if normalized_name not in results:
+                results[normalized_name] = self.search(normalized_name,
+                                                       threshold, matcher)
+            ret.append(results[normalized_name])
+        return ret
+
+    def team(self, name):
+        '''Team with alias `name`, or None.'''
+        tid = self.team_id(name)
+        if tid is None:
+            return None
+        return self._object(Team, tid)
+
+    def team_by_id(self, tid):
+        '''Team with given ID, or None.'''
+        return self._object(Team, tid)
+
+    def team_by_name(self, name):
+        '''Team whose name is exactly `name`, or None if there is no such
+        Team or the name is ambiguous.'''
+        tid = self.names.get(name)
+        if tid is None:
+            return None
+        return self._object(Team, tid)
+
+    def squad(self, team_id, season):
+        '''Squad of Team with given ID in season, or None.'''
+        sid = self.squads.get((team_id, season))
+        if sid is None:
+            squad = self._session.query(Squad)\
+                                 .filter(Squad.team_id==team_id,
+                                         Squad.season==season).first()
+            if squad is None:
+                return None
+            self.squads[(team_id, season)] = squad.id
+            self._objects[(Squad, squad.id)] = squad
+            return squad
+        return self._object(Squad, sid)
+
+    def _object(self, cls, id_):
+        '''Instance of cls with given ID, from the index if it's still in the
+        Session, otherwise from the Session.'''
+        obj = self._objects.get((cls, id_))
+        if obj is None or obj not in self._session:
+            obj = self._objects[(cls, id_)] = self._session.query(cls).get(id_)
+        return obj
+
+    # Attributes the index is keyed on
+    _keys = {
+        'TeamAlias' : ('name', 'team_id', 'team'),
+        'Team'      : ('name',),
+        'Squad'     : ('team_id', 'team', 'season'),
+    }
+
+    def sync(self, new, dirty, deleted):
+        '''Add flushed objects to the index. Returns False if dirty or
+        deleted objects affect the index, which then has to be reloaded.'''
+        for obj in deleted:
+            if isinstance(obj, (TeamAlias, Team, Squad)):
+                return False
+        for obj in dirty:
+            keys = self._keys.get(type(obj).__name__)
+            if keys is not None:
+                attrs = inspect(obj).attrs
+                for key in keys:
+                    if attrs[key].history.has_changes():
+                        return False
+        for obj in new:
+            if isinstance(obj, TeamAlias):
+                self._add_alias(obj.name, obj.team_id)
+            elif isinstance(obj, Team):
+                self._add_name(obj.name, obj.id)
+            elif isinstance(obj, Squad):
+                self.squads[(obj.team_id, obj.season)] = obj.id
+        return True
+
+    def __repr__(self):
+        return "<TeamIndex(%d aliases, %d squads)>" % (len(self.aliases),
+                                                       len(self.squads))
+
+
+@event.listens_for(Session, 'after_flush')
+def _sync_team_index(session, flush_context):
+    index = getattr(session, '_team_index', None)
+    if index is not None and \
+       not index.sync(session.new, session.dirty, session.deleted):
+        del session._team_index
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_team_index_on_rollback(session, previous_transaction):
+    if getattr(session, '_team_index', None) is not None:
+        del session._team_index
+
+
+
+
 # - TournamentGame -- /
 class TournamentGame(Game):
     '''Subclass of Game. Polymorphic: TournamentGame can stand in for Game.'''
@@ -980,70 +1795,13 @@ class TournamentGame(Game):
 
 
 
-# - Tournament -- /
-class Tournament(Base):
-    '''Tournament is an iterable binary heap, which is accessible using
-    common names for rounds and regions. These names are configurable on
-    initialization. Games are stored as TournamentGames. Neither of the
-    Tournament data structures are stored in the stats DB.'''
-    __tablename__ = 'tournament'
-
-    id = Column(Integer, primary_key=True)
-
-    regions_store = Column(String)
-    rounds_store = Column(String)
-    delim = Column(String)
-    season = Column(String)
-    playin = Column(String)
-
-    # Transient default scores for pointsmap - not saved in DB
-    # Converted to pointsmap based on round names in _reconstruct().
-    # Ordered from Championship (0th element) to 1st round (5th element).
-    # This is the default value; it's the system used by ESPN.
-    roundpoints = [320, 160, 80, 40, 20, 10, 0]
-
-    # Note: games = many-to-one relationship to Tournament.games
-
-    def __init__(self, season,
-                 regions=['North', 'East', 'South', 'West'],
-                 rounds=None, delim='/', playin=True):
-
-        self.season = season
-        self.regions_store = '|'.join(regions)
-        self.regions = regions # transient
-        if playin:
-            self.playin = 'playin' if type(playin) is bool else str(playin)
-        else:
-            self.playin = None
-
-        self.delim = delim
-
-        if rounds is not None:
-            self.rounds_store = '|'.join(rounds)
-
-        self._reconstruct()
-
-    @reconstructor
-    def _reconstruct(self):
-        '''Reconstruct transient attributes from DB values'''
-        if self.rounds_store is None:
-            self.rounds = ['finals', 'finalfour',
-                            'elite8', 'sweet16', '2nd', '1st']
-            if self.playin is not None:
-                self.rounds.append(self.playin)
-        else:
-            self.rounds = self.rounds_store.split('|')
-
-        if not hasattr(self, 'regions'):
-            self.regions = self.regions_store.split('|')
-
-        if self.games is None or not len(self.games):
-            self.games = [TournamentGame(self, i)
-                            for i in range((1<<len(self.rounds))-1)]
-
-        # Pair default round points with round labels from DB
-        self.pointsmap = dict(zip(self.rounds, self.roundpoints))
-        self.points = None
+# - BracketLayout -- /
+class BracketLayout(object):
+    '''Heap layout shared by Tournament and the transient Bracket in
+    ncaalib.bracket: translation between heap indexes and round, region and
+    position, and serialization. Subclasses provide season, rounds, regions,
+    delim, playin, __len__ and __getitem__, which returns the game at a heap
+    index with opponents, winner, loser, winner_score and loser_score.'''
 
     def lookup(self, n):
         # Find depth in tree
@@ -1078,10 +1836,6 @@ class Tournament(Base):
 
         return (self.rounds[round_id], self.regions[region_id], num)
 
-    def set(self, data, round_, region=0, n=0):
-        idx = self.index(round_, region, n)
-        self.games[idx] = data
-
     def index(self, round_, region=0, n=0):
         if type(region) is not int:
             if region is None:
@@ -1112,101 +1866,15 @@ class Tournament(Base):
         # Find horizontal offset in row
         return rowinitid + (region*gsize) + n
 
-    def get(self, round_, region=0, n=0):
-        idx = self.index(round_, region, n)
-        return self.games[idx]
-
-    def get_by_id(self, n):
-        return self.games[n]
-
-    def set_by_id(self, n, data):
-        self.games[n] = data
-
-    def __getitem__(self, n):
-        return self.games[n]
-
-    def __setitem__(self, n, data):
-        self.games[n] = data
-
-    def simulate(self, decide):
-        '''Simulate tournament with given decision function. Decision fn must
-        return either Game (with 'winner' attribute filled out), a tuple of
-        Squads in the form [winner, loser], the Squad that won, or the index
-        in Game.opponents of the given Game of the winner.'''
-        for tgame in self:
-            if len(tgame.opponents)!=2:
-                # Make sure game has right number of opponents
-                if self.playin and log2(tgame.index+1)==len(self.rounds)-1:
-                    # In playin round
-                    if len(tgame.opponents)==0:
-                        # This is OK. PlayIn round is not complete
-                        continue
-                raise IndexError("%s opponents in game %d" \
-                                    % (len(tgame.opponents), tgame.index))
-
-            r = decide(tgame)
-            if type(r) is Game:
-                tgame = r
-            elif type(r) is tuple or type(r) is list:
-                tgame.winner = r[0]
-                tgame.loser = r[1]
-            elif type(r) is Squad:
-                tgame.winner = r
-                lid = (tgame.opponents.index(r)+1)%2
-                tgame.loser = tgame.opponents[lid]
-            elif type(r) is int:
-                tgame.winner = tgame.opponents[r]
-                tgame.loser = tgame.opponents[(r+1)%2]
-            elif type(r) is np.ndarray or type(r) is list:
-                i = int(r[0])
-                tgame.winner = tgame.opponents[i]
-                tgame.loser = tgame.opponents[(i+1)%2]
-            else:
-                raise NotImplementedError("Unsupported sim return type %s"\
-                                            % type(r))
-
-            nextroundgame = tgame.next()
-
-            if nextroundgame:
-                nextroundgame.opponents.append(tgame.winner)
-
-    def __iter__(self):
-        return TournamentIterator(self)
-
-    def __len__(self):
-        return len(self.games)
-
-    def __repr__(self):
-        return "<Tournament('%s')>" % self.season
-
-    def empty_bracket(self, name=None):
-        '''Return a clone of this Tournament that has not been filled out,
-        except for the first round. Designate its moniker.'''
-        if name is None:
-            name = "%s-empty-%d" % (self.season, randint(0, 1000000))
-
-        newtourny = Tournament(name, rounds=self.rounds, regions=self.regions,
-                               delim='/', playin=self.playin)
-        # Get index - start of first round
-        fr_start = self.index(self.rounds[-2 if self.playin else -1])
-        # Iterate to end of Tournament, copy TournamentGame opponents
-        for i in range(fr_start, len(self)):
-            newtourny[i].opponents = [t for t in self[i].opponents]
-
-        # If there's a playin round, make playin round winners unknown
-        if self.playin is not None:
-            pl_start = self.index(self.rounds[-1])
-            for i in range(pl_start, len(self)):
-                ops = newtourny[i].opponents
-                if len(ops)==2:
-                    # This play-in game is filled (this round is mostly empty)
-                    fr_ops = newtourny[i].next().opponents
-                    newtourny[i].next().opponents = [s for s in fr_ops
-                                                        if s not in ops]
-
-        # Return new Tournament
-        return newtourny
-
+    def round_points(self, pointsmap=None):
+        '''Points for a correct pick in each round, Championship first, from
+        a dict mapping round labels to points, a list already in that order
+        or, by default, self.pointsmap.'''
+        if pointsmap is None:
+            pointsmap = self.pointsmap
+        if type(pointsmap) is dict:
+            return [pointsmap.get(r, 0) for r in self.rounds]
+        return list(pointsmap)
 
     def export(self, format='heap', meta=None):
         '''Serialize tournament. Supports to methods of serialization. First
@@ -1336,6 +2004,264 @@ class Tournament(Base):
         # Serialize output
         return json.dumps(output)
 
+
+
+
+# - Tournament -- /
+class Tournament(BracketLayout, Base):
+    '''Tournament is an iterable binary heap, which is accessible using
+    common names for rounds and regions. These names are configurable on
+    initialization. Games are stored as TournamentGames. Neither of the
+    Tournament data structures are stored in the stats DB.'''
+    __tablename__ = 'tournament'
+
+    id = Column(Integer, primary_key=True)
+
+    regions_store = Column(String)
+    rounds_store = Column(String)
+    delim = Column(String)
+    season = Column(String)
+    playin = Column(String)
+
+    # Transient default scores for pointsmap - not saved in DB
+    # Converted to pointsmap based on round names in _reconstruct().
+    # Ordered from Championship (0th element) to 1st round (5th element).
+    # This is the default value; it's the system used by ESPN.
+    roundpoints = [320, 160, 80, 40, 20, 10, 0]
+
+    # Note: games = many-to-one relationship to Tournament.games
+
+    def __init__(self, season,
+                 regions=['North', 'East', 'South', 'West'],
+                 rounds=None, delim='/', playin=True):
+
+        self.season = season
+        self.regions_store = '|'.join(regions)
+        self.regions = regions # transient
+        if playin:
+            self.playin = 'playin' if type(playin) is bool else str(playin)
+        else:
+            self.playin = None
+
+        self.delim = delim
+
+        if rounds is not None:
+            self.rounds_store = '|'.join(rounds)
+
+        self._reconstruct()
+
+    @reconstructor
+    def _reconstruct(self):
+        '''Reconstruct transient attributes from DB values'''
+        if self.rounds_store is None:
+            self.rounds = ['finals', 'finalfour',
+                            'elite8', 'sweet16', '2nd', '1st']
+            if self.playin is not None:
+                self.rounds.append(self.playin)
+        else:
+            self.rounds = self.rounds_store.split('|')
+
+        if not hasattr(self, 'regions'):
+            self.regions = self.regions_store.split('|')
+
+        if self.games is None or not len(self.games):
+            self.games = [TournamentGame(self, i)
+                            for i in range((1<<len(self.rounds))-1)]
+
+        # Pair default round points with round labels from DB
+        self.pointsmap = dict(zip(self.rounds, self.roundpoints))
+        self.points = None
+
+    def set(self, data, round_, region=0, n=0):
+        idx = self.index(round_, region, n)
+        self.games[idx] = data
+
+    def get(self, round_, region=0, n=0):
+        idx = self.index(round_, region, n)
+        return self.games[idx]
+
+    def get_by_id(self, n):
+        return self.games[n]
+
+    def set_by_id(self, n, data):
+        self.games[n] = data
+
+    def __getitem__(self, n):
+        return self.games[n]
+
+    def __setitem__(self, n, data):
+        self.games[n] = data
+
+    def simulate(self, decide, precompute=False):
+        '''Simulate tournament with given decision function. Decision fn must
+        return either Game (with 'winner' attribute filled out), a tuple of
+        Squads in the form [winner, loser], the Squad that won, or the index
+        in Game.opponents of the given Game of the winner.
+
+        The bracket is played a round at a time; if decide has a decide_many
+        method, it is given all Games of a round at once and must return a
+        list of decisions in the same order. Pass precompute=True to have
+        decide's precompute method (see GameDecider) called with the Squads
+        in the bracket first. That decides every pairing of the field, so it
+        only pays off when the same decide is used over and over.'''
+        if precompute and hasattr(decide, 'precompute'):
+            from bracket import tournament_leaves
+            field = [s for s in tournament_leaves(self) if s is not None]
+            decide.precompute(field)
+
+        decide_many = getattr(decide, 'decide_many', None)
+
+        for depth in xrange(len(self.rounds)-1, -1, -1):
+            # Games of the round, in the same order as iterating over self
+            games = []
+            for idx in xrange((1<<(depth+1))-2, (1<<depth)-2, -1):
+                tgame = self.games[idx]
+                if len(tgame.opponents)!=2:
+                    # Make sure game has right number of opponents
+                    if self.playin and depth==len(self.rounds)-1:
+                        # In playin round
+                        if len(tgame.opponents)==0:
+                            # This is OK. PlayIn round is not complete
+                            continue
+                    raise IndexError("%s opponents in game %d" \
+                                        % (len(tgame.opponents), tgame.index))
+                games.append(tgame)
+
+            if decide_many is not None:
+                results = decide_many(games)
+            else:
+                results = [decide(tgame) for tgame in games]
+
+            for tgame, r in zip(games, results):
+                tgame = self._record_decision(tgame, r)
+
+                nextroundgame = tgame.next()
+
+                if nextroundgame:
+                    nextroundgame.opponents.append(tgame.winner)
+
+    def _record_decision(self, tgame, r):
+        '''Set winner and loser of tgame from what a decision function
+        returned. Returns the Game that was decided.'''
+        if type(r) is Game:
+            tgame = r
+        elif type(r) is tuple or type(r) is list:
+            tgame.winner = r[0]
+            tgame.loser = r[1]
+        elif type(r) is Squad:
+            tgame.winner = r
+            lid = (tgame.opponents.index(r)+1)%2
+            tgame.loser = tgame.opponents[lid]
+        elif type(r) is int:
+            tgame.winner = tgame.opponents[r]
+            tgame.loser = tgame.opponents[(r+1)%2]
+        elif type(r) is np.ndarray or type(r) is list:
+            i = int(r[0])
+            tgame.winner = tgame.opponents[i]
+            tgame.loser = tgame.opponents[(i+1)%2]
+        else:
+            raise NotImplementedError("Unsupported sim return type %s"\
+                                        % type(r))
+        return tgame
+
+    def advancement_probabilities(self, prob_fn):
+        '''Exact probability of each Squad in the bracket winning its game in
+        each round, given prob_fn(a, b), the probability that Squad a beats
+        Squad b. Works on empty and on filled in brackets; only the Squads
+        entering the bracket matter. See ncaalib.bracket for the method.
+        Requires numpy.
+
+        Returns (squads, table), where table is a (squads x rounds) array.
+        Columns follow self.rounds, so table[:, 0] are the probabilities of
+        winning the championship.'''
+        from bracket import advancement_probabilities
+
+        squads, leaves, probs = self._bracket_matrix(prob_fn)
+        return squads, advancement_probabilities(leaves, probs)
+
+    def optimal_bracket(self, prob_fn, pointsmap=None, name=None):
+        '''Fill out the bracket with the highest expected score, given
+        prob_fn(a, b), the probability that Squad a beats Squad b, and the
+        points for each round (self.pointsmap by default; a list ordered like
+        self.roundpoints or a dict like self.pointsmap). Unlike simulate with
+        a greedy decision function, this may pick an underdog early on when
+        the favorite is unlikely to go much further. See
+        ncaalib.bracket.optimal_bracket. Requires numpy.
+
+        Returns (bracket, expected), where bracket is made with
+        empty_bracket(name) and filled in with the picks, and expected is
+        its expected score.'''
+        from bracket import optimal_bracket
+
+        points = self.round_points(pointsmap)
+        squads, leaves, probs = self._bracket_matrix(prob_fn)
+        picks, expected = optimal_bracket(leaves, probs, points)
+
+        bracket = self.empty_bracket(name)
+
+        def _pick(tgame):
+            winner = squads[picks[tgame.index]]
+            return tgame.opponents.index(winner)
+
+        bracket.simulate(_pick)
+        return bracket, expected
+
+    def _bracket_matrix(self, prob_fn):
+        '''Squads entering the bracket, the bracket's leaves as indexes into
+        that list (-1 for byes), and the matrix of prob_fn over all pairs.'''
+        from bracket import tournament_leaves
+
+        leaves = tournament_leaves(self)
+        squads = []
+        rows = dict()
+        for squad in leaves:
+            if squad is not None and squad.id not in rows:
+                rows[squad.id] = len(squads)
+                squads.append(squad)
+
+        probs = np.zeros((len(squads), len(squads)))
+        for i, a in enumerate(squads):
+            for j, b in enumerate(squads):
+                if i!=j:
+                    probs[i, j] = prob_fn(a, b)
+
+        leaves = [-1 if s is None else rows[s.id] for s in leaves]
+        return squads, leaves, probs
+
+    def __iter__(self):
+        return TournamentIterator(self)
+
+    def __len__(self):
+        return len(self.games)
+
+    def __repr__(self):
+        return "<Tournament('%s')>" % self.season
+
+    def empty_bracket(self, name=None, persist=False):
+        '''Return a clone of this Tournament that has not been filled out,
+        except for the first round. Designate its moniker.
+
+        The clone is a transient Bracket (see ncaalib.bracket), which
+        simulates, scores and exports like a Tournament without touching the
+        DB. It is copied from a template that is made from this Tournament
+        the first time, and shares the template's Squads and first round
+        layout, so cloning only costs the arrays of winners and losers. Pass
+        persist=True to get a new Tournament instead, e.g. to store it.'''
+        if name is None:
+            name = "%s-empty-%d" % (self.season, randint(0, 1000000))
+
+        template = getattr(self, '_empty_template', None)
+        if template is None:
+            from bracket import Bracket
+            template = Bracket.from_tournament(self).empty()
+            self._empty_template = template
+
+        bracket = template.empty(name)
+        if persist:
+            return bracket.to_tournament()
+        return bracket
+
+
     def score(self, realtourny, pointsmap=None):
         '''Score this Tournament based on the actual results. By default
         uses the scoring system used by ESPN. Optionally pass a dictionary
@@ -1389,6 +2315,99 @@ to unknown round %s" % (val, key))
             else:
                 self[i].accurate = realtourny[i].winner == self[i].winner
 
+    @classmethod
+    def cached_export(cls, session, tournament_id, format='heap'):
+        '''Serialized Tournament (see export) as a JSON string, served from
+        the tournamentexport table when the Tournament hasn't changed since
+        it was last exported. Only the version of the data is computed on a
+        hit, with one query; the Tournament isn't loaded. On a miss the
+        export is stored in the Session's transaction (not committed). If
+        the table can't be read or written (dbmgr hasn't created it yet, or
+        the database is read-only), this is the same as export(). Returns
+        None if there is no such Tournament.'''
+        format = format.lower()
+        version = cls.export_version(session, tournament_id)
+        if version is None:
+            return None
+
+        t = tournamentexport
+        key = (t.c.tournament_id==tournament_id) & (t.c.format==format)
+        try:
+            row = session.execute(select([t.c.version, t.c.data])\
+                                    .where(key)).first()
+        except OperationalError:
+            row = None
+        if row is not None and row.version==version:
+            return row.data
+
+        data = session.query(cls).get(tournament_id).export(format)
+        if type(data) is unicode:
+            data = data.encode('utf8')
+
+        try:
+            session.execute(t.delete().where(key))
+            session.execute(t.insert().values(tournament_id=tournament_id,
+                                              format=format,
+                                              version=version,
+                                              data=data))
+        except OperationalError:
+            # Not cached this time
+            pass
+        return data
+
+    @classmethod
+    def export_version(cls, session, tournament_id):
+        '''Digest of everything that goes into the export of a Tournament:
+        its layout, its games' results and opponents, and their seeds and
+        team names. Changes whenever any of them changes. Returns None if
+        there is no such Tournament.'''
+        tourny = cls.__table__
+        tgame = TournamentGame.__table__
+        game = Game.__table__
+        squad = Squad.__table__
+        team = Team.__table__
+
+        head = session.execute(select([tourny.c.season, tourny.c.regions_store,
+                                       tourny.c.rounds_store, tourny.c.delim,
+                                       tourny.c.playin])\
+                                 .where(tourny.c.id==tournament_id)).first()
+        if head is None:
+            return None
+
+        q = select([tgame.c.index, game.c.winner_id, game.c.loser_id,
+                    game.c.winner_score, game.c.loser_score,
+                    schedule.c.squad_id, squad.c.seed, team.c.name])\
+              .select_from(tgame.join(game, game.c.id==tgame.c.id)\
+                                .outerjoin(schedule,
+                                           schedule.c.game_id==game.c.id)\
+                                .outerjoin(squad,
+                                           squad.c.id==schedule.c.squad_id)\
+                                .outerjoin(team, team.c.id==squad.c.team_id))\
+              .where(tgame.c.tournament_id==tournament_id)\
+              .order_by(tgame.c.index, schedule.c.squad_id)
+
+        digest = hashlib.md5(repr(tuple(head)))
+        for row in session.execute(q):
+            digest.update(repr(tuple(row)))
+        return digest.hexdigest()
+
+
+
+# - Tournament Exports -- /
+'''Serialized Tournaments, with the version of the data they were made
+from. Maintained by Tournament.cached_export.'''
+tournamentexport = Table('tournamentexport', Base.metadata,
+    Column('id', Integer, primary_key=True),
+    Column('tournament_id', Integer, ForeignKey('tournament.id',
+                                                onupdate='cascade')),
+    Column('format', String),
+    Column('version', String),
+    Column('data', LargeBinary)
+)
+Index('ix_tournamentexport_tournament_format',
+      tournamentexport.c.tournament_id, tournamentexport.c.format,
+      unique=True)
+
 
 
 # - TournamentIterator -- /
@@ -1417,11 +2436,19 @@ class GameDecider(object):
     implement classify() (like NLTK) or predict() (like SKL), you can pass
     (as a string) the method to call for classification in the `method`
     parameter. This method should expect as a parameter whatever you return
-    from your `extractor`.'''
+    from your `extractor`.
+
+    Decisions are cached on the GameDecider by the IDs of the two opponents
+    (in order). Call precompute with the Squads of a field to classify every
+    pairing in one batched call up front, e.g. before simulating the same
+    bracket many times. The cache assumes the classifier doesn't change:
+    make a new GameDecider (or call clear_cache) after refitting it.'''
+
     def __init__(self, classifier, extractor, normalize=None, method=None):
         self.classifier = classifier
         self.extractor = extractor
         self.normalize = normalize
+        self._cache = dict()
 
         if method is None:
             if hasattr(classifier, 'classify'):
@@ -1437,14 +2464,68 @@ class GameDecider(object):
     def __call__(self, game, prob=False):
         '''Extract features from given Game, then classify.
         Also normalizes if you're into that.'''
-        ft = self.extractor(*game.opponents)
+        return self.decide_many([game], prob)[0]
+
+    def decide_many(self, games, prob=False):
+        '''Decide a list of Games, e.g. a round of a Tournament. Pairings
+        that aren't cached are classified together in one call. Returns a
+        list with what __call__ would return for each Game.'''
+        cache = self._decisions(prob)
+        keys = [tuple(s.id for s in game.opponents) for game in games]
+
+        missing = OrderedDict()
+        for key, game in zip(keys, games):
+            if key not in cache:
+                missing[key] = game.opponents
+
+        if missing:
+            features = [self.features(a, b) for a, b in missing.values()]
+            for key, p in zip(missing, self._classify(prob, features)):
+                cache[key] = p
+
+        return [cache[key] for key in keys]
+
+    def features(self, a, b):
+        '''Feature vector for Squad a against Squad b, normalized if there's
+        a normalizer.'''
+        ft = self.extractor(a, b)
         if self.normalize is not None:
             ft = self.normalize(ft)
-        if prob:
-            p = self.proba_method(ft)
-        else:
-            p = self.method(ft)
-        return p
+        return ft
+
+    def precompute(self, squads, prob=False):
+        '''Classify every ordered pair of distinct Squads in squads that isn't
+        cached yet, with one call to the classifier when features are numpy
+        arrays (as with SciKit-Learn). A field of 64 Squads has 4032
+        pairs.'''
+        cache = self._decisions(prob)
+        pairs = [(a, b) for a in squads for b in squads
+                    if a.id!=b.id and (a.id, b.id) not in cache]
+        if not pairs:
+            return
+        results = self._classify(prob, [self.features(a, b) for a, b in pairs])
+        for (a, b), p in zip(pairs, results):
+            cache[(a.id, b.id)] = p
+
+    def clear_cache(self):
+        '''Forget cached decisions, e.g. after refitting the classifier.'''
+        self._cache.clear()
+
+    def _decisions(self, prob):
+        '''Cached decisions (or probabilities, if prob) of this
+        GameDecider.'''
+        return self._cache.setdefault(bool(prob), dict())
+
+    def _classify(self, prob, features):
+        '''Classify a list of feature vectors. Returns a list of what the
+        classifier returns for each of them on its own. Arrays are stacked
+        into a matrix and classified at once; anything else (e.g. NLTK
+        feature dicts) one at a time.'''
+        method = self.proba_method if prob else self.method
+        if not all(type(ft) is np.ndarray and ft.ndim==1 for ft in features):
+            return [method(ft) for ft in features]
+        results = method(np.vstack(features))
+        return [results[i:i+1] for i in xrange(len(features))]
 
 
 
@@ -1452,9 +2533,53 @@ class GameDecider(object):
 
 
 # -- HELPER FUNCTIONS -- //
+def _complete_games_source(session):
+    '''Highest IDs of the game and squadmember tables, as a string. These
+    are primary key lookups, so this is cheap enough to check on every
+    sample; it catches new rows, but not edits made by another process.'''
+    game = Game.__table__
+    member = SquadMember.__table__
+    ids = [session.execute(select([func.max(game.c.id)])).scalar(),
+           session.execute(select([func.max(member.c.id)])).scalar()]
+    return ','.join(str(i) for i in ids)
+
+
+def _char_keys(name):
+    '''Characters of name as (character, k) pairs, where k counts earlier
+    occurrences of the same character. Two names share as many keys as they
+    have characters in common.'''
+    seen = defaultdict(int)
+    keys = []
+    for c in name:
+        keys.append((c, seen[c]))
+        seen[c] += 1
+    return keys
+
+
+def _trigrams(name):
+    '''Set of character trigrams in (normalized) name. The name is padded so
+    that short names have trigrams too.'''
+    padded = '  %s ' % name
+    return set(padded[i:i+3] for i in xrange(len(padded)-2))
+
+
+
+
+_non_alphanumeric = re.compile(r'[^\w\d]')
+_normalized_names = dict()
+
 def normalize_name(name):
-    '''Normalize team name to upper case and with no non-alpha-numeric chars.'''
-    return re.sub(r'[^\w\d]', '', name.upper())
+    '''Normalize team name to upper case and with no non-alpha-numeric chars.
+    Results are memoized, since the same few hundred names come up over and
+    over during ingest.'''
+    try:
+        return _normalized_names[name]
+    except KeyError:
+        if len(_normalized_names) > 100000:
+            _normalized_names.clear()
+        normalized = _normalized_names[name] = \
+                _non_alphanumeric.sub('', name.upper())
+        return normalized
 
 
 
@@ -1471,12 +2596,9 @@ def log2(x):
 
 def get_team_by_name(session, name):
     '''Convenience function for searching teams by name. Returns a Team
-    if one is found, otherwise returns None.'''
-    normalized_name = normalize_name(name)
-    ta = session.query(TeamAlias).filter_by(name=normalized_name).first()
-    if ta is None:
-        return None
-    return ta.team
+    if one is found, otherwise returns None. Served from the session's
+    TeamIndex.'''
+    return TeamIndex.get(session).team(name)
 
 
 
@@ -1491,36 +2613,9 @@ def fuzzy_match_team(session, name, threshold=.9, matcher=fuzzymatch):
 
     Returns OrderedDict of IDs of Teams hwose name (any variation of it)
     matches the provided `name` above a certain threshold. Keys are IDs,
-    values are match percentile.'''
-    normalized_name = normalize_name(name)
-
-    match_func = lambda s: matcher(normalized_name, s)
-
-    # Create a function for the SQL to use
-    c = session.bind.connect()
-    c.connection.create_function('distance', 1, match_func)
-
-    # Execute query
-    query = "SELECT `team_id`, distance(name) \
-             FROM `teamalias` \
-             WHERE distance(name)>=:threshold"
-    res = c.execute(query, dict(threshold=threshold))
-
-    if res is None:
-        return None
-
-    unique_results = OrderedDict()
-    for row in res:
-        # Compact results into ordered dict by referenced Team name and store
-        # highest score
-        if unique_results.has_key(row[0]) and \
-           unique_results[row[0]]>row[1]:
-            # Stored match is higher
-            continue
-        unique_results[row[0]] = row[1]
-
-    # Sort results and return
-    return OrderedDict(sorted(unique_results.items(), key=lambda d: d[1]))
+    values are match percentile. Candidates are shortlisted with the
+    session's TeamIndex.'''
+    return TeamIndex.get(session).search(name, threshold, matcher)
 
 
 
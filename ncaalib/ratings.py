@@ -33,10 +33,12 @@ from sys import exit
 # Load intramodule classes
 from aux.output import *
 from ncaa import *
+from frame import SeasonFrame
 
 # Try to load third-party (but common) libraries
 try:
     from scipy.sparse.linalg import lsqr
+    from scipy.sparse import coo_matrix
 except ImportError:
     print_warning("Module scipy is missing. Can't do any algebra.")
 
@@ -180,6 +182,174 @@ class LeastSquaresRater(SquadRater):
 
 
 
+class RPIRater(SquadRater):
+    '''Season-wide RPI. Produces the same numbers as Squad.get_rpi, but for
+    every Squad in the season at once: the season's results are taken from a
+    SeasonFrame and reduced to a sparse Squad x Squad matrix of games played,
+    so that OWP and OOWP are just a couple of matrix products instead of tens
+    of thousands of walks through Squad.opponents(). Pass a frame to reuse one
+    that is already loaded.
+
+    After rate() the components are available as arrays aligned with
+    self.ids: wp, wwp, owp, oowp and rpi, plus pwwp, the weighted win pct
+    counting postseason games too. Undefined values (e.g., Squads
+    with no games played) are NaN in the arrays and None in the returned
+    dict, just like Squad.get_rpi.'''
+
+    # Weights used for weighted win pct. These are what the NCAA uses, and
+    # the same ones as in Squad.win_pct.
+    home_win_weight = away_loss_weight = .6
+    away_win_weight = home_loss_weight = 1.4
+
+    def __init__(self, session, season, frame=None):
+        if frame is None:
+            frame = SeasonFrame(session, season, statsheets=False)
+        self.frame = frame
+
+        super(RPIRater, self).__init__(session, season)
+
+        self.ids = frame.squad_ids
+        self.names = frame.team_names
+        # (id, team name) of every Squad in the season, ordered by ID
+        self.squad_keys = zip(self.ids, self.names)
+
+        # Per-game arrays, with Squads given as rows in self.ids
+        self._winner = frame.winner
+        self._loser = frame.loser
+        self._postseason = frame.postseason
+        self._arena = frame.arena
+        self._a = frame.matchups[:, 0]
+        self._b = frame.matchups[:, 1]
+
+    def _get_squads(self):
+        '''Get squads who played games in the given season, like
+        SquadRater._get_squads, but in one query: the frame already knows
+        whose schedules are empty.'''
+        played = set(sid for i, sid in enumerate(self.frame.squad_ids)
+                         if len(self.frame.schedule(i)))
+        squads = self._session.query(Squad)\
+                     .filter(Squad.season==self.season)\
+                     .order_by(Squad.id)\
+                     .all()
+        return [squad for squad in squads if squad.id in played]
+
+    def _count(self, pos, mask, weights=None):
+        '''Sum weights (default 1) by Squad position for masked games.'''
+        mask = mask & (pos>=0)
+        if weights is not None:
+            weights = weights[mask]
+        return np.bincount(pos[mask], weights=weights,
+                           minlength=len(self.ids)).astype(float)
+
+    def _weighted_record(self, regular):
+        '''Weighted wins and losses in played games selected by regular
+        (usually the regular-season ones). A game is away for a Squad if
+        played at its opponent's arena, home if at its own arena, neutral
+        otherwise.'''
+        played = regular & (self._winner>=0) & (self._b>=0)
+        a, b = self._a[played], self._b[played]
+        arena = self._arena[played]
+        winner = self._winner[played]
+
+        w = np.zeros(len(self.ids))
+        l = np.zeros(len(self.ids))
+
+        for me, op in [(a, b), (b, a)]:
+            away = arena==self.names[op]
+            home = ~away & (arena==self.names[me])
+            won = winner==me
+
+            wt = np.ones(len(me))
+            wt[away & won] = self.away_win_weight
+            wt[home & won] = self.home_win_weight
+            wt[away & ~won] = self.away_loss_weight
+            wt[home & ~won] = self.home_loss_weight
+
+            w += np.bincount(me[won], weights=wt[won], minlength=len(w))
+            l += np.bincount(me[~won], weights=wt[~won], minlength=len(l))
+
+        return w, l
+
+    def _opponents_matrix(self, regular):
+        '''Sparse matrix A where A[i, j] is the number of regular-season
+        games Squad i has played (won or lost) against Squad j.'''
+        pair = regular & (self._b>=0)
+        a, b = self._a[pair], self._b[pair]
+        winner, loser = self._winner[pair], self._loser[pair]
+
+        played_a = ((winner==a) | (loser==a)).astype(float)
+        played_b = ((winner==b) | (loser==b)).astype(float)
+
+        n = len(self.ids)
+        A = coo_matrix((np.concatenate([played_a, played_b]),
+                        (np.concatenate([a, b]), np.concatenate([b, a]))),
+                       shape=(n, n))
+        return A.tocsr()
+
+    def rate(self, mutate=True):
+        '''Calculate WP, weighted WP, OWP, OOWP and RPI for every Squad in
+        the season. Set mutate to False to skip writing RPIs back to the
+        squad table. Writes are done in bulk and are not committed.
+
+        Returns dict mapping Squad IDs to RPIs.'''
+        everything = np.ones(len(self._winner), dtype=bool)
+        regular = ~self._postseason
+
+        # Plain win pct counts postseason games, like Squad.win_pct()
+        w = self._count(self._winner, everything)
+        l = self._count(self._loser, everything)
+
+        # Regular season record of each Squad
+        rw = self._count(self._winner, regular)
+        rl = self._count(self._loser, regular)
+        rgp = rw + rl
+
+        ww, wl = self._weighted_record(regular)
+        pww, pwl = self._weighted_record(everything)
+
+        A = self._opponents_matrix(regular)
+
+        # OWP pools opponents' records; OOWP pools opponents' opponents'.
+        # Each opponent counts once per game played against them.
+        aw, agp = A.dot(rw), A.dot(rgp)
+        aaw, aagp = A.dot(aw), A.dot(agp)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.wp = w / (w+l)
+            self.wwp = ww / (ww+wl)
+            self.pwwp = pww / (pww+pwl)
+            self.owp = aw / agp
+            self.oowp = aaw / aagp
+
+        self.rpi = .25*self.wwp + .5*self.owp + .25*self.oowp
+
+        ret = dict((int(sid), None if np.isnan(r) else float(r))
+                        for sid, r in zip(self.ids, self.rpi))
+
+        if mutate:
+            self._save(ret)
+
+        return ret
+
+    def _save(self, ratings):
+        '''Write RPIs to the squad table with a single executemany, then
+        expire the attribute on any Squads already loaded in the session.'''
+        squad = Squad.__table__
+        stmt = squad.update()\
+                    .where(squad.c.id==bindparam('sid'))\
+                    .values(rpi=bindparam('rpi_'))
+
+        if len(ratings):
+            self._session.execute(stmt, [dict(sid=sid, rpi_=rpi)
+                                          for sid, rpi in ratings.items()])
+
+        for obj in self._session.identity_map.values():
+            if isinstance(obj, Squad) and obj.id in ratings:
+                self._session.expire(obj, ['rpi'])
+
+
+
+
 if __name__=='__main__':
     from sys import argv
     if len(argv)!=2:
@@ -206,6 +376,20 @@ if __name__=='__main__':
         raters[season] = lsr
 
     print_success("Graphed and rated all teams in all available season.")
+
+    print_info("Calculating RPIs on all available years ...")
+
+    # Save RPI raters by season, too
+    rpiraters = dict()
+
+    for season in seasons:
+        print_comment("  * %s ... " % season)
+        rr = RPIRater(session, season)
+        rr.rate(mutate=True)
+        print_good("     - done!")
+        rpiraters[season] = rr
+
+    print_success("Rated all teams in all available seasons by RPI.")
     print_comment("Saving changes to database ... ")
 
     session.commit()
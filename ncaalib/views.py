@@ -0,0 +1,328 @@
+#-*- coding: utf8 -*-
+'''
+ncaalib.views
+
+Detached, read-only value objects for Squads, their derived stats and
+Games, for use in simulation and feature extraction.
+
+ORM objects are big, they drag their Session along with them and they can
+issue queries whenever an attribute is touched. The views here hold only
+plain values in __slots__, are built for a whole season at once from a
+SeasonFrame plus one query for derived stats, and pickle to a few hundred
+bytes each, so they can be shipped to worker processes cheaply.
+
+SquadView answers the attributes feature extractors use on Squads (id,
+team.name, rpi, lsalpha, seed, stats.*, win_pct(), get_rpi()), and GameView
+the ones GameDecider and the Tournament code use on Games (opponents, winner,
+loser), so both can be passed wherever a Squad or a Game is expected for
+reading.
+SquadRegistry collects SquadViews across seasons, extracting each Squad
+once, and keeps their derived stats as rows of one float array.
+
+Copyright (c) 2013 Joe Nudell.
+Freely distributable under the MIT License.
+'''
+
+from ncaa import *
+from frame import SeasonFrame, to_int, to_float
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+
+
+
+class StatsView(object):
+    '''Read-only copy of a DerivedStats record. Supports the same access as
+    DerivedStats: attributes, item lookup and items().'''
+
+    fields = tuple(['games_played'] + DerivedStats.sumfields
+                   + sorted(DerivedStats.pctfields.keys()))
+
+    __slots__ = fields
+
+    def __init__(self, values):
+        '''Initialize from a sequence of values ordered like
+        StatsView.fields. Missing values should be None.'''
+        for field, val in zip(self.fields, values):
+            object.__setattr__(self, field, val)
+
+    @classmethod
+    def from_stats(cls, stats):
+        '''Copy a DerivedStats (or anything that supports item lookup).'''
+        return cls([stats[field] for field in cls.fields])
+
+    def __getitem__(self, item):
+        '''Alias of getattr'''
+        return getattr(self, item)
+
+    def items(self):
+        '''For iteration. Same keys as DerivedStats.items().'''
+        keys = DerivedStats.sumfields + DerivedStats.pctfields.keys()
+        return [(key, getattr(self, key)) for key in keys]
+
+    def __setattr__(self, attr, val):
+        raise AttributeError("StatsView is read-only")
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.fields)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return "<StatsView(%s games played)>" % self.games_played
+
+
+
+
+TeamView = namedtuple('TeamView', ['id', 'name'])
+
+
+
+
+class SquadView(object):
+    '''Read-only snapshot of a Squad. Squads with the same ID compare equal,
+    so views can be matched up after a trip through pickle.
+
+    wp is the plain win pct and wwp the weighted, regular season win pct,
+    i.e. Squad.win_pct() and Squad.win_pct(weighted=True); pwwp is
+    Squad.win_pct(weighted=True, postseason=True). rpi is the value stored
+    in the DB, or the freshly computed one if none is stored. team is a
+    TeamView with the Team's ID and name, like Squad.team.'''
+
+    __slots__ = ('id', 'season', 'team_id', 'name', 'seed', 'rpi', 'lsalpha',
+                 'conference', 'rank', 'wp', 'wwp', 'pwwp', 'stats')
+
+    def __init__(self, **values):
+        for attr in self.__slots__:
+            object.__setattr__(self, attr, values.get(attr))
+
+    @classmethod
+    def load(cls, session, season, frame=None):
+        '''Build views of every Squad in season. Pass a SeasonFrame to reuse
+        one that is already loaded. Derived stats that haven't been cached
+        yet are summed by the DB for the views, without writing them (run
+        DerivedStats.backfill, or dbmgr -b, to cache them).
+
+        Returns an OrderedDict mapping Squad IDs to SquadViews, in the same
+        order as the frame's rows.'''
+        from ratings import RPIRater
+
+        if frame is None:
+            frame = SeasonFrame(session, season, statsheets=False)
+
+        rater = RPIRater(session, season, frame=frame)
+        rater.rate(mutate=False)
+
+        stats = _load_stats(session, season)
+
+        views = OrderedDict()
+        for i, sid in enumerate(frame.squad_ids):
+            sid = int(sid)
+            rpi = frame.rpi[i]
+            if np.isnan(rpi):
+                rpi = rater.rpi[i]
+            views[sid] = cls(id=sid,
+                             season=season,
+                             team_id=to_int(frame.team_ids[i]),
+                             name=frame.team_names[i],
+                             seed=to_int(frame.seeds[i]),
+                             rpi=to_float(rpi),
+                             lsalpha=to_float(frame.lsalpha[i]),
+                             conference=frame.conference[i],
+                             rank=to_int(frame.rank[i]),
+                             wp=to_float(rater.wp[i]),
+                             wwp=to_float(rater.wwp[i]),
+                             pwwp=to_float(rater.pwwp[i]),
+                             stats=stats.get(sid))
+        return views
+
+    def get_rpi(self):
+        '''RPI of Squad. Views are read-only, so this is just self.rpi.'''
+        return self.rpi
+
+    @property
+    def team(self):
+        return TeamView(self.team_id, self.name)
+
+    def win_pct(self, weighted=False, postseason=False):
+        '''Win pct as of when the view was built, like Squad.win_pct. As
+        there, postseason only matters for the weighted win pct.'''
+        if weighted:
+            return self.pwwp if postseason else self.wwp
+        return self.wp
+
+    def __setattr__(self, attr, val):
+        raise AttributeError("SquadView is read-only")
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, val in zip(self.__slots__, state):
+            object.__setattr__(self, attr, val)
+
+    def __eq__(self, other):
+        return isinstance(other, SquadView) and other.id==self.id
+
+    def __ne__(self, other):
+        return not self==other
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return "<SquadView('%s', '%s')>" % (self.name, self.season)
+
+
+
+
+class SquadRegistry(object):
+    '''SquadViews of any number of seasons, each extracted once and numbered
+    in the order they were added. rows maps Squad IDs to those numbers and
+    stats holds the derived stats of the Squads as rows of one float array,
+    with columns StatsView.fields (NaN where missing), for use in bulk.
+    Look views up by Squad ID with registry[id].'''
+
+    def __init__(self):
+        self.views = []
+        self.rows = dict()
+        self.seasons = set()
+        self.stats = np.empty((0, len(StatsView.fields)))
+
+    def load(self, session, season, frame=None):
+        '''Extract every Squad of season (see SquadView.load), unless that
+        has been done already. Returns self.'''
+        if season in self.seasons:
+            return self
+
+        views = SquadView.load(session, season, frame=frame)
+        new = [v for v in views.values() if v.id not in self.rows]
+        for view in new:
+            self.rows[view.id] = len(self.views)
+            self.views.append(view)
+
+        stats = np.empty((len(new), len(StatsView.fields)))
+        for i, view in enumerate(new):
+            stats[i] = [np.nan if val is None else val
+                            for val in _stats_values(view.stats)]
+        self.stats = np.vstack([self.stats, stats])
+        self.seasons.add(season)
+        return self
+
+    def row(self, squad_id):
+        '''Number of the Squad with given ID'''
+        return self.rows[squad_id]
+
+    def __getitem__(self, squad_id):
+        return self.views[self.rows[squad_id]]
+
+    def __contains__(self, squad_id):
+        return squad_id in self.rows
+
+    def __len__(self):
+        return len(self.views)
+
+    def __repr__(self):
+        return "<SquadRegistry(%d squads, %s)>" \
+                % (len(self), ", ".join(sorted(self.seasons)))
+
+
+
+
+class GameView(object):
+    '''Read-only snapshot of a Game. opponents, winner and loser are
+    SquadViews (winner and loser are None if the Game hasn't been played).'''
+
+    __slots__ = ('id', 'date', 'opponents', 'winner', 'loser',
+                 'winner_score', 'loser_score', 'postseason', 'overtime',
+                 'arena')
+
+    def __init__(self, **values):
+        for attr in self.__slots__:
+            object.__setattr__(self, attr, values.get(attr))
+
+    @classmethod
+    def load(cls, session, season, squads=None, frame=None):
+        '''Build views of every Game in season. squads is the result of
+        SquadView.load for the same season and frame; it is loaded if not
+        given. Games with a Squad from outside the season get None for that
+        Squad.
+
+        Returns an OrderedDict mapping Game IDs to GameViews, ordered by
+        ID.'''
+        if frame is None:
+            frame = SeasonFrame(session, season, statsheets=False)
+        if squads is None:
+            squads = SquadView.load(session, season, frame=frame)
+
+        rows = list(squads.values())
+        view = lambda i: rows[i] if i>=0 else None
+
+        views = OrderedDict()
+        for g, gid in enumerate(frame.game_ids):
+            gid = int(gid)
+            a, b = frame.matchups[g]
+            views[gid] = cls(id=gid,
+                             date=frame.dates[g],
+                             opponents=(view(a), view(b)) if a>=0 else (),
+                             winner=view(frame.winner[g]),
+                             loser=view(frame.loser[g]),
+                             winner_score=to_int(frame.winner_score[g]),
+                             loser_score=to_int(frame.loser_score[g]),
+                             postseason=bool(frame.postseason[g]),
+                             overtime=to_int(frame.overtime[g]),
+                             arena=frame.arena[g])
+        return views
+
+    def __contains__(self, squad):
+        return squad in self.opponents
+
+    def __setattr__(self, attr, val):
+        raise AttributeError("GameView is read-only")
+
+    def __getstate__(self):
+        return tuple(getattr(self, attr) for attr in self.__slots__)
+
+    def __setstate__(self, state):
+        for attr, val in zip(self.__slots__, state):
+            object.__setattr__(self, attr, val)
+
+    def __repr__(self):
+        names = " vs. ".join(s.name for s in self.opponents if s is not None)
+        return "<GameView('%s', '%s')>" % (names, self.date)
+
+
+
+
+# -- HELPER FUNCTIONS -- //
+def _load_stats(session, season):
+    '''StatsViews of every Squad in season, by Squad ID. Cached stats take
+    one query; Squads without any are summed like DerivedStats.rebuild does,
+    but nothing is written to the DB.'''
+    squad = Squad.__table__
+    cache = DerivedStats.__table__
+
+    cols = [getattr(cache.c, field) for field in StatsView.fields]
+    q = select([squad.c.id] + cols)\
+          .select_from(squad.join(cache, cache.c.id==squad.c.stats_id))\
+          .where(squad.c.season==season)
+    stats = dict((r[0], StatsView(r[1:]))
+                    for r in session.execute(q).fetchall())
+
+    missing = session.execute(select([func.count(squad.c.id)])\
+                                .where(squad.c.season==season)\
+                                .where(squad.c.stats_id==None))\
+                     .scalar()
+    if missing:
+        for sid, _, _, sums in DerivedStats._squad_sums(session, season,
+                                                        missing_only=True):
+            stats[sid] = StatsView.from_stats(sums)
+    return stats
+
+
+def _stats_values(stats):
+    '''Values of a StatsView in the order of StatsView.fields, or Nones'''
+    if stats is None:
+        return [None] * len(StatsView.fields)
+    return [getattr(stats, field) for field in StatsView.fields]
@@ -74,7 +74,8 @@ if __name__=='__main__':
     # Connect to database
     session = load_db('data/ncaa.db')
 
-    # Get a random sample of games from the DB.
+    # Get a random sample of games from the DB. Games with complete data are
+    # indexed by dbmgr; on older DBs the index is built by the first call.
     print_info("Creating sample from games in DB")
     some_games = Game.get_games_with_data(session, limit=500)
     sample = []
@@ -116,10 +117,12 @@ if __name__=='__main__':
     def _extract_and_convert(*g):
         return data.convert(extract_features(*g))
 
+    # Extracted Tournaments are cached, and reused until the DB changes
     scorer = TournamentScorer(session,
                               _extract_and_convert,
                               seasons=tourny_years,
-                              normalize=data.normalize)
+                              normalize=data.normalize,
+                              cache_dir='data/scorer-cache')
 
     classifier = GridSearchCV(SVC(probability=True), grid, scoring=scorer,
                               verbose=2, refit=True, n_jobs=-1, cv=4)
@@ -147,7 +150,9 @@ if __name__=='__main__':
         # Pull tournament of given year from the database.
         t = session.query(Tournament).filter_by(season=season).one()
         
-        # Create an empty bracket from this real tournament
+        # Create an empty bracket from this real tournament. This is a
+        # transient Bracket; use t.empty_bracket(persist=True) for a
+        # Tournament that can be stored in the DB.
         b = t.empty_bracket()
         
         # Simulate tournament using empty bracket
@@ -13,6 +13,7 @@ import cgi
 import json
 import os
 from ncaalib.ncaa import *
+from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 
 # Get GET
@@ -33,25 +34,36 @@ else:
         # Fetch from db
         session = load_db('../../data/ncaa.db')
         
+        # Try to pull tournament record from database
+        tid = None
+
         try:
-            # Try to pull tournament record from database
-            t = None
-            
             if filter_=='id':
                 # Default: pull by ID
-                t = session.query(Tournament).get(int(key))
+                tid = int(key)
             elif filter_=='season':
                 # Alternative: pull by season
-                t = session.query(Tournament).filter_by(season=key).one()
+                tid = session.query(Tournament.id)\
+                             .filter_by(season=key).one()[0]
             else:
                 # No other query filters are supported currently
                 ret['error'] = 'unsupported query filter'
-                
-            if t is not None:
-                ret = t.export(method)
-        except:
+        except (ValueError, NoResultFound, MultipleResultsFound):
             ret['error'] = 'key not found'
 
+        if tid is not None:
+            # Served from the export cache unless the bracket changed
+            try:
+                data = Tournament.cached_export(session, tid, method)
+            except NotImplementedError:
+                ret['error'] = 'unsupported method'
+            else:
+                if data is None:
+                    ret['error'] = 'key not found'
+                else:
+                    ret = data
+                    session.commit()
+
     else:
         # Fetch from local scrap
         spaths = [key+'.js', key+'.json',